@@ -1,17 +1,2286 @@
-import tkinter as tk
-from tkinter import messagebox, ttk, filedialog
 import os
+import sys
 import subprocess
 from datetime import datetime
-from tkinterdnd2 import DND_FILES, TkinterDnD
-from PIL import Image, ImageTk
+from PIL import Image, ImageDraw, ImageFont, ImageMath, GifImagePlugin
 import math
 import threading
 import tempfile
 import shlex
+import argparse
+import glob
+import json
+import logging
+import random
+import re
+import time
+import sqlite3
+import struct
+import zlib
+import bisect
+import mmap
+import ctypes
+import select
+import fnmatch
+import hashlib
+import atexit
+import shutil
+import io
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+try:
+    import tkinter as tk
+    from tkinter import messagebox, ttk, filedialog
+    from PIL import ImageTk
+except ImportError:  # headless boxes only need Pillow for the batch CLI
+    tk = messagebox = ttk = filedialog = ImageTk = None
+try:
+    from tkinterdnd2 import DND_FILES, TkinterDnD
+except ImportError:
+    DND_FILES = TkinterDnD = None
+try:
+    import fcntl
+    import resource
+except ImportError:  # Windows: msvcrt locks files, and there is no getrusage
+    fcntl = resource = None
+    import msvcrt
 
 Image.MAX_IMAGE_PIXELS = None
 
+DEFAULT_SETTINGS = {
+    'mode': "horizontal", 'format': "jpg", 'quality': 94, 'spacing': 0,
+    'grid_cols': 0, 'grid_fit': "crop", 'use_smallest': False, 'canvas_w': 0,
+    'canvas_h': 0, 'border': 0, 'best_fit': False, 'show_labels': False,
+    'normalize_size': False, 'target_size': 800, 'match_size': False, 'match_smallest': True,
+    'engine': "magick", 'memory_budget': 0, 'cache_outputs': False, 'prenormalize_workers': 0,
+    'animate': "off", 'frame_delay': 0, 'pixel_cache': False, 'chunk_size': 0, 'variants': ""
+}
+
+CACHE_DIR = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.expanduser('~/.cache'), 'ImageMerger')
+
+# --- Instrumentation ---------------------------------------------------------------
+
+# `operation` groups the spans of one preview, merge or batch job; `seconds` is the span's wall time.
+Span = namedtuple('Span', 'operation name start seconds attrs')
+
+class Operation:
+    def __init__(self, name):
+        self.name = name
+        self.totals = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def summary(self):
+        """'probe 3ms · decode 120ms · magick 2.1s' over top-level stages; threaded stages sum their threads."""
+        with self.lock:
+            parts = [(k, v) for k, v in self.totals.items() if ':' not in k]
+        return " · ".join(f"{k} {v * 1000:.0f}ms" if v < 1 else f"{k} {v:.1f}s" for k, v in parts)
+
+class Tracer:
+    """Times named stages and hands each finished Span to the sinks; spans also total on the thread's Operation."""
+    def __init__(self):
+        self.sinks = []
+        self.local = threading.local()
+        self.monitor_magick = False  # add -monitor to magick commands and time its stages
+        self.magick_bench = 0        # add -bench N to (non-montage) magick commands
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def current(self):
+        return getattr(self.local, 'op', None)
+
+    @contextmanager
+    def bind(self, op):
+        """Make `op` current on this thread too, e.g. in a pool worker doing part of its work."""
+        previous, self.local.op = self.current(), op
+        try:
+            yield op
+        finally:
+            self.local.op = previous
+
+    @contextmanager
+    def operation(self, name):
+        op = Operation(name)
+        with self.bind(op), self.span(name, op=op):
+            yield op
+
+    @contextmanager
+    def span(self, name, op=None, **attrs):
+        op = op or self.current()
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            self.record(name, start, time.perf_counter() - start, op, **attrs)
+
+    def record(self, name, start, seconds, op=None, **attrs):
+        """Report a stage timed elsewhere, e.g. from a subprocess's own progress output."""
+        if op is not None and name != op.name:
+            op.add(name, seconds)
+        span = Span(op.name if op else None, name, start, seconds, attrs)
+        for sink in self.sinks:
+            try:
+                sink(span)
+            except Exception:
+                pass
+
+class LogSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("ImageMerger")
+        self.level = level
+
+    def __call__(self, span):
+        attrs = " ".join(f"{k}={v}" for k, v in span.attrs.items())
+        self.logger.log(self.level, "%s/%s %.1fms %s", span.operation, span.name, span.seconds * 1000, attrs)
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        record = {'operation': span.operation, 'name': span.name, 'seconds': round(span.seconds, 6),
+                  'time': time.time(), **span.attrs}
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+class RingBufferSink:
+    """Keeps the latest `maxlen` spans in memory, e.g. for the GUI's per-stage breakdown."""
+    def __init__(self, maxlen=2000):
+        self.buffer = deque(maxlen=maxlen)
+
+    def __call__(self, span):
+        self.buffer.append(span)
+
+    def spans(self, operation=None):
+        return [s for s in list(self.buffer) if operation is None or s.operation == operation]
+
+    def last(self, operation):
+        """Spans of the latest finished `operation`, ending with its own (recorded when it closes)."""
+        spans = self.spans(operation)
+        outer = next((s for s in reversed(spans) if s.name == operation), None)
+        if outer is None:
+            return []
+        return [s for s in spans if outer.start <= s.start <= outer.start + outer.seconds and s is not outer] + [outer]
+
+TRACER = Tracer()
+
+MONITOR_LINE = re.compile(r'^(?P<stage>[A-Za-z][\w/ -]*?)(?:\[(?P<target>.*)\])?: (?P<done>\d+) of (?P<total>\d+), '
+                          r'\d+% complete')
+PERFORMANCE_LINE = re.compile(r'Performance(?:\[\d+\])?: .*?(?P<elapsed>[\d:.]+)$')
+
+# `error` is set (and the size is 0×0) when the file could not be read as an image
+ImageInfo = namedtuple('ImageInfo', 'width height format alpha frames error', defaults=(1, None))
+UNREADABLE = ImageInfo(0, 0, None, False, 0, "file not found")
+
+# Leading bytes of the formats people actually drop, so the header parser is picked without asking
+# every registered Pillow plugin in turn
+SIGNATURES = [(b'\xff\xd8\xff', 'JPEG'), (b'\x89PNG\r\n\x1a\n', 'PNG'), (b'GIF87a', 'GIF'), (b'GIF89a', 'GIF'),
+              (b'BM', 'BMP'), (b'II*\x00', 'TIFF'), (b'MM\x00*', 'TIFF')]
+
+def sniff_format(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return next((fmt for magic, fmt in SIGNATURES if head.startswith(magic)), None)
+
+def probe_image(path):
+    """Read only the header of `path` (Image.open is lazy) and return its ImageInfo."""
+    try:
+        with open(path, 'rb') as f:
+            fmt = sniff_format(f.read(16))
+            f.seek(0)
+            try:
+                img = Image.open(f, formats=[fmt] if fmt else None)
+            except Image.UnidentifiedImageError:
+                f.seek(0)
+                img = Image.open(f)
+            with img:
+                alpha = img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in img.info
+                # n_frames walks GIF frame headers (no pixel data); other formats store the count
+                return ImageInfo(img.width, img.height, img.format, alpha, getattr(img, 'n_frames', 1))
+    except Image.UnidentifiedImageError:
+        return ImageInfo(0, 0, None, False, 0, "not a recognised image")
+    except Exception as e:
+        return ImageInfo(0, 0, None, False, 0, str(e) or type(e).__name__)
+
+class MetadataCache:
+    """LRU cache of ImageInfo keyed by (path, size, mtime), probed in parallel, optionally kept in SQLite."""
+    def __init__(self, max_entries=50000, workers=0):
+        self.max_entries = max_entries
+        self.workers = workers or min(32, 4 * (os.cpu_count() or 1))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        self.pending = []
+        self.inflight = {}  # key -> Future of a probe under way
+
+    def attach(self, db_path):
+        """Persist entries to `db_path` so they survive restarts; failures leave the cache memory-only."""
+        try:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            db = sqlite3.connect(db_path, check_same_thread=False)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(info)')]
+            if columns and 'frames' not in columns:
+                db.execute('DROP TABLE info')  # written by an older version; it is only a cache
+            db.execute('CREATE TABLE IF NOT EXISTS info (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                       'width INTEGER, height INTEGER, format TEXT, alpha INTEGER, frames INTEGER, used REAL)')
+            # Trim the on-disk copy with the same LRU policy as memory
+            db.execute('DELETE FROM info WHERE path NOT IN (SELECT path FROM info ORDER BY used DESC LIMIT ?)',
+                       (self.max_entries,))
+            db.commit()
+            with self.lock:
+                self.db = db
+        except sqlite3.Error:
+            pass
+
+    @staticmethod
+    def key(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def get(self, path):
+        return self.get_many([path])[0]
+
+    def get_many(self, paths, callback=None):
+        """ImageInfo of every path; `callback(index, path, info)` fires as each arrives, from the probing threads."""
+        infos, futures, owned = [None] * len(paths), {}, []
+        for i, path in enumerate(paths):
+            key, info = self._cached(path)
+            if info is None:
+                with self.lock:
+                    future = self.inflight.get(key)
+                    if future is None:
+                        future = self.inflight[key] = Future()
+                        owned.append((key, path, future))
+                futures[future] = futures.get(future, []) + [i]
+                continue
+            infos[i] = info
+            if callback:
+                callback(i, path, info)
+        if len(owned) > 1 and self.workers > 1:
+            pool = ThreadPoolExecutor(max_workers=min(self.workers, len(owned)))
+            for job in owned:
+                pool.submit(self._probe, *job)
+            pool.shutdown(wait=False)
+        else:
+            for job in owned:
+                self._probe(*job)
+        for future in as_completed(futures):
+            for i in futures[future]:
+                infos[i] = future.result()
+                if callback:
+                    callback(i, paths[i], infos[i])
+        self.flush()
+        return infos
+
+    def peek_many(self, paths):
+        """The cached ImageInfo of each path, or None where it has not been probed yet; never probes."""
+        return [self._cached(path)[1] for path in paths]
+
+    def warm(self, paths, callback=None):
+        """Probe `paths` on a background thread so the next preview finds them cached."""
+        thread = threading.Thread(target=self.get_many, args=(list(paths), callback), daemon=True)
+        thread.start()
+        return thread
+
+    def _cached(self, path):
+        key = self.key(path)
+        if key is None:
+            return None, UNREADABLE
+        with self.lock:
+            info = self.entries.get(key)
+            if info is not None:
+                self.entries.move_to_end(key)
+                return key, info
+            if self.db is not None:
+                row = self.db.execute('SELECT width, height, format, alpha, frames FROM info WHERE path=? '
+                                      'AND size=? AND mtime=?', key).fetchone()
+                if row:
+                    info = ImageInfo(row[0], row[1], row[2], bool(row[3]), row[4])
+                    self._store(key, info, persist=True)  # refreshes its LRU timestamp on disk
+                    return key, info
+        return key, None
+
+    def _probe(self, key, path, future):
+        try:
+            info = probe_image(path)
+        except BaseException as e:
+            with self.lock:
+                self.inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            # unreadable files are remembered for this session only; they may be mid-copy
+            self._store(key, info, persist=info.error is None)
+            self.inflight.pop(key, None)
+        future.set_result(info)
+        return info
+
+    def _store(self, key, info, persist):
+        self.entries[key] = info
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if persist and self.db is not None:
+            self.pending.append(key + (info.width, info.height, info.format, int(info.alpha), info.frames,
+                                       time.time()))
+
+    def flush(self):
+        with self.lock:
+            if not self.pending or self.db is None:
+                return
+            rows, self.pending = self.pending, []
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO info VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self.db.commit()
+            except sqlite3.Error:
+                pass
+
+META_CACHE = MetadataCache()
+
+def get_dimensions(paths):
+    with TRACER.span('probe', files=len(paths)):
+        return [(info.width, info.height) for info in META_CACHE.get_many(paths)]
+
+def build_command(sources, s, output_path, preview=False, dims=None, filelist=None):
+    """Build the magick argv for `sources`; `filelist` is an @file to use instead of the paths."""
+    # Optimization: Remove harmful escaping. shell=False handles paths correctly.
+    paths = [p.replace('\\', '/') for p in sources]
+    output_path = output_path.replace('\\', '/')
+    
+    mode = s['mode']
+    scale = 0.5 if preview else 1.0
+
+    if mode == "ashlar":
+        dims = dims or get_dimensions(sources)
+        if not dims:
+            return None
+        
+        # One-pass composite of the precomputed packing (see pack_ashlar) onto an exact-size canvas
+        layout = plan_layout(dims, s, preview, names=sources)
+        bg = 'transparent' if layout.background == TRANSPARENT else 'white'
+        cmd = ['magick', '-quiet', '-size', f'{layout.width}x{layout.height}', f'xc:{bg}', '-depth', '8']
+        for t in layout.tiles:
+            cmd.extend(ashlar_tile_args(paths[t.index], t))
+        if s['format'] in ['jpg', 'jpeg']:
+            cmd.extend(['-sampling-factor', '4:4:4', '-quality', str(85 if scale < 1 else s['quality'])])
+        cmd.append(output_path)
+        return cmd
+
+    elif mode == "grid":
+        cols = s['grid_cols'] or int(math.ceil(math.sqrt(len(paths))))
+        
+        cmd = ['magick', 'montage', '-quiet']
+        cmd.extend(([filelist] if filelist else paths) + ['-depth', '8'])
+        
+        if s['grid_fit'] in ["crop", "scale"]:
+            dims = [d for d in (dims or get_dimensions(sources)) if d[0] > 0 and d[1] > 0]
+            if dims:
+                if s['use_smallest']:
+                    tw, th = min(dims, key=lambda d: d[0] * d[1])
+                else:
+                    tw = sum(w for w,h in dims) // len(dims)
+                    th = sum(h for w,h in dims) // len(dims)
+                if scale < 1:
+                    tw, th = int(tw * scale), int(th * scale)
+                fit_bg = 'white' if s['format'] in ['jpg', 'jpeg'] else 'transparent'
+                if s['grid_fit'] == "crop":
+                    # cover: fill the box, crop whatever overflows
+                    cmd.extend(['-resize', f'{tw}x{th}^', '-gravity', 'center', '-extent', f'{tw}x{th}'])
+                else:
+                    # scale (contain): fit inside the box, pad the shortfall
+                    cmd.extend(['-resize', f'{tw}x{th}', '-gravity', 'center',
+                                '-background', fit_bg, '-extent', f'{tw}x{th}'])
+        
+        bg = 'white' if s['format'] in ['jpg', 'jpeg'] else 'transparent'
+        sp = s['spacing']
+        cmd.extend(['-background', bg, '-tile', f'{cols}x', '-geometry', f'+{sp}+{sp}'])
+        if s['format'] in ['jpg', 'jpeg']:
+            cmd.extend(['-sampling-factor', '4:4:4', '-quality', str(85 if scale < 1 else s['quality']), 
+                    '-alpha', 'remove', '-alpha', 'off'])
+        cmd.append(output_path)
+        return cmd
+
+    else:  # horizontal/vertical
+        cmd = ['magick', '-quiet']
+        cmd.extend([filelist] if filelist else paths)
+        
+        if scale < 1:
+            cmd.extend(['-resize', '800x800>'])
+        
+        if s['match_size']:
+            dims = dims or get_dimensions(sources)
+            if dims:
+                func = min if s['match_smallest'] else max
+                if mode == "vertical":
+                    w = func(w for w,h in dims if w > 0)
+                    if w > 0:
+                        target = int(w * scale) if scale < 1 else w
+                        cmd.extend(['-resize', f'{min(target, 800)}x' if scale < 1 else f'{w}x'])
+                else:
+                    h = func(h for w,h in dims if h > 0)
+                    if h > 0:
+                        target = int(h * scale) if scale < 1 else h
+                        cmd.extend(['-resize', f'x{min(target, 800)}' if scale < 1 else f'x{h}'])
+        
+        if s['spacing'] > 0:
+            cmd.extend(['-bordercolor', 'transparent', '-border', 
+                    f'{s["spacing"]}x{s["spacing"]}'])
+        cmd.append('+append' if mode == "horizontal" else '-append')
+        if s['format'] in ['jpg', 'jpeg']:
+            cmd.extend(['-sampling-factor', '4:4:4', '-quality', str(85 if scale < 1 else s['quality'])])
+        cmd.append(output_path)
+        return cmd
+
+def ashlar_tile_args(path, t, dx=0, dy=0):
+    """magick arguments compositing one Ashlar tile onto the image before them, shifted by (-dx, -dy)."""
+    args = ['(', f'{path}[0]', '-resize', f'{t.rw}x{t.rh}!']
+    if t.label:
+        args.extend(['(', '-size', f'{t.rw}x{t.h - t.rh}', '-background', 'white', '-fill', 'black',
+                     '-gravity', 'center', f'label:{t.label}', ')', '-append'])
+    return args + [')', '-geometry', f'+{t.x - dx}+{t.y - dy}', '-composite']
+
+# --- Ashlar packing -----------------------------------------------------------------
+
+def skyline_pack(sizes, width):
+    """Best-fit skyline packing into a strip `width` wide; returns ([(x, y) or None], used height)."""
+    skyline = [[0, 0, width]]  # segments of x, y, w
+    placements, used = [], 0
+    for w, h in sizes:
+        best = None
+        for i, (x, _, _) in enumerate(skyline):
+            if x + w > width:
+                break
+            limit = best[0] - h if best else width * width
+            y, reach, j = 0, x, i
+            while reach < x + w:
+                sx, sy, sw = skyline[j]
+                if sy > y:
+                    y = sy
+                    if y > limit:
+                        break
+                reach = sx + sw
+                j += 1
+            if y > limit:
+                continue
+            waste, reach, j = 0, x, i
+            while reach < x + w:
+                sx, sy, sw = skyline[j]
+                waste += (y - sy) * (min(sx + sw, x + w) - max(sx, x))
+                reach = sx + sw
+                j += 1
+            candidate = (y + h, waste, x, i, y)
+            if best is None or candidate < best:
+                best = candidate
+        if best is None:
+            placements.append(None)
+            continue
+        top, _, x, i, y = best
+        placements.append((x, y))
+        used = max(used, top)
+        # raise the skyline under the new rectangle, splitting the segment it ends in
+        right = x + w
+        j = i
+        while j < len(skyline) and skyline[j][0] < right:
+            sx, sy, sw = skyline[j]
+            if sx + sw > right:
+                skyline[j] = [right, sy, sx + sw - right]
+                break
+            del skyline[j]
+        skyline.insert(i, [x, top, w])
+        for k in (i, i - 1):  # merge with the right neighbour, then the left, at equal heights
+            if 0 <= k < len(skyline) - 1 and skyline[k][1] == skyline[k + 1][1]:
+                skyline[k][2] += skyline[k + 1][2]
+                del skyline[k + 1]
+    return placements, used
+
+ASHLAR_PACKINGS = OrderedDict()  # (sizes, border, canvas, best_fit) -> pack_ashlar result, latest last
+ASHLAR_PACKINGS_LOCK = threading.Lock()
+
+def pack_ashlar(sizes, border=0, canvas=None, best_fit=False):
+    """Place (w, h) images with `border` px around them; returns (placements or None, canvas w, canvas h)."""
+    # previews re-plan on every settings tick; the packing only changes with these inputs
+    key = (tuple(sizes), border, canvas, best_fit)
+    with ASHLAR_PACKINGS_LOCK:
+        packed = ASHLAR_PACKINGS.get(key)
+        if packed is not None:
+            ASHLAR_PACKINGS.move_to_end(key)
+            return packed
+    packed = _pack_ashlar(sizes, border, canvas, best_fit)
+    with ASHLAR_PACKINGS_LOCK:
+        ASHLAR_PACKINGS[key] = packed
+        while len(ASHLAR_PACKINGS) > 8:
+            ASHLAR_PACKINGS.popitem(last=False)
+    return packed
+
+def _pack_ashlar(sizes, border, canvas, best_fit):
+    padded = [(w + border, h + border) for w, h in sizes]
+    order = list(range(len(sizes)))
+    if best_fit:
+        order.sort(key=lambda i: (-padded[i][1], -padded[i][0]))
+    ordered = [padded[i] for i in order]
+
+    def attempt(strip):
+        spots, used = skyline_pack(ordered, strip)
+        placements = [None] * len(sizes)
+        for i, spot in zip(order, spots):
+            placements[i] = spot
+        return placements, used
+
+    if canvas:
+        cw, ch = canvas
+        placements, _ = attempt(max(cw - border, 1))
+        placements = [p if p and p[1] + padded[i][1] + border <= ch else None for i, p in enumerate(placements)]
+        return placements, cw, ch
+
+    widest = max(w for w, h in padded)
+    side = math.sqrt(sum(w * h for w, h in padded))
+    best = None
+    for factor in (1.0, 1.15, 1.3, 1.5):
+        placements, used = attempt(max(widest, int(side * factor)))
+        right = max(x + padded[i][0] for i, (x, y) in enumerate(placements))
+        cw, ch = right + border, used + border
+        # smallest area first, then the squarer canvas
+        score = (cw * ch, abs(cw - ch))
+        if best is None or score < best[0]:
+            best = (score, placements, cw, ch)
+    return best[1], best[2], best[3]
+
+def packing_efficiency(layout):
+    """Share of the canvas covered by images."""
+    return sum(t.rw * t.rh for t in layout.tiles) / max(layout.width * layout.height, 1)
+
+def plan_ashlar(dims, s, scale, background, names=None):
+    sizes = []
+    for w, h in dims:
+        if s['normalize_size']:
+            target = max(1, int(s['target_size'] * scale))
+            w, h = _scaled(w, h, min(target / w, target / h))
+        elif scale < 1:
+            w, h = _scaled(w, h, scale)
+        sizes.append((w, h))
+    label_h = max(10, int(16 * scale)) if s['show_labels'] else 0
+    boxes = [(w, h + label_h) for w, h in sizes]
+    border = int(s['border'] * scale)
+    cw, ch = s['canvas_w'], s['canvas_h']
+    canvas = (int(cw * scale), int(ch * scale)) if cw and ch else None
+    placements, width, height = pack_ashlar(boxes, border, canvas, s['best_fit'])
+    tiles = []
+    for i, spot in enumerate(placements):
+        if spot is None:
+            continue
+        (rw, rh), (bw, bh) = sizes[i], boxes[i]
+        label = os.path.splitext(os.path.basename(names[i]))[0] if label_h and names else None
+        tiles.append(Tile(i, spot[0] + border, spot[1] + border, bw, bh, rw, rh, 0, 0,
+                          WHITE if label_h else None, label))
+    return Layout(width, height, background, tiles, True)
+
+# --- In-process compositing engine ----------------------------------------------
+
+WHITE, TRANSPARENT = (255, 255, 255, 255), (0, 0, 0, 0)
+
+# A source resized to rw x rh and placed at (ox, oy) inside the w x h box at (x, y), clipped to the box.
+# `fill` paints the box first (spacing border / extent padding); None leaves it transparent.
+# `label` is drawn in the strip below the image (Ashlar labels).
+Tile = namedtuple('Tile', 'index x y w h rw rh ox oy fill label', defaults=(None,))
+# `composite` blends tiles over the background like montage; False copies them like -append.
+Layout = namedtuple('Layout', 'width height background tiles composite')
+
+def _scaled(w, h, factor):
+    return max(1, int(w * factor + 0.5)), max(1, int(h * factor + 0.5))
+
+def plan_layout(dims, s, preview=False, names=None):
+    """Tile placement matching build_command's output; None for modes it can't plan."""
+    mode = s['mode']
+    scale = 0.5 if preview else 1.0
+    fmt_bg = WHITE if s['format'] in ['jpg', 'jpeg'] else TRANSPARENT
+    sp = s['spacing']
+
+    if mode == "ashlar":
+        return plan_ashlar(dims, s, scale, TRANSPARENT if s['format'] == 'png' else WHITE, names)
+
+    if mode == "grid":
+        n = len(dims)
+        cols = min(s['grid_cols'] or int(math.ceil(math.sqrt(n))), n)
+        rows = -(-n // cols)
+        fit = s['grid_fit']
+        valid = [d for d in dims if d[0] > 0 and d[1] > 0]
+        if fit in ["crop", "scale"] and valid:
+            if s['use_smallest']:
+                tw, th = min(valid, key=lambda d: d[0] * d[1])
+            else:
+                tw = sum(w for w,h in valid) // len(valid)
+                th = sum(h for w,h in valid) // len(valid)
+            if scale < 1:
+                tw, th = int(tw * scale), int(th * scale)
+        else:
+            # montage without a tile size uses the largest width and height
+            fit = "original"
+            tw, th = max(w for w,h in dims), max(h for w,h in dims)
+        tiles = []
+        for i, (w, h) in enumerate(dims):
+            if fit == "crop":
+                rw, rh = _scaled(w, h, max(tw / w, th / h))
+            elif fit == "scale":
+                rw, rh = _scaled(w, h, min(tw / w, th / h))
+            else:
+                rw, rh = w, h
+            x = (i % cols) * (tw + 2 * sp) + sp
+            y = (i // cols) * (th + 2 * sp) + sp
+            tiles.append(Tile(i, x, y, tw, th, rw, rh, (tw - rw) // 2, (th - rh) // 2,
+                              fmt_bg if fit == "scale" else None))
+        return Layout(cols * (tw + 2 * sp), rows * (th + 2 * sp), fmt_bg, tiles, True)
+
+    if mode not in ["horizontal", "vertical"]:
+        return None
+
+    sizes = []
+    for w, h in dims:
+        if scale < 1 and max(w, h) > 800:
+            w, h = _scaled(w, h, min(800 / w, 800 / h))
+        sizes.append((w, h))
+    if s['match_size']:
+        func = min if s['match_smallest'] else max
+        if mode == "vertical":
+            target = func(w for w,h in dims)
+            target = min(int(target * scale), 800) if scale < 1 else target
+            sizes = [(target, max(1, int(h * target / w + 0.5))) for w, h in sizes]
+        else:
+            target = func(h for w,h in dims)
+            target = min(int(target * scale), 800) if scale < 1 else target
+            sizes = [(max(1, int(w * target / h + 0.5)), target) for w, h in sizes]
+
+    tiles, offset = [], 0
+    for i, (w, h) in enumerate(sizes):
+        bw, bh = w + 2 * sp, h + 2 * sp
+        x, y = (offset, 0) if mode == "horizontal" else (0, offset)
+        tiles.append(Tile(i, x, y, bw, bh, w, h, sp, sp, TRANSPARENT if sp else None))
+        offset += bw if mode == "horizontal" else bh
+    if mode == "horizontal":
+        width, height = offset, max(t.h for t in tiles)
+    else:
+        width, height = max(t.w for t in tiles), offset
+    # -append fills gaps with the default background (white) and copies pixels, alpha included
+    return Layout(width, height, WHITE, tiles, False)
+
+def load_source(path, size=None):
+    """Decode the first frame of `path` as RGBA. `size` is the tile it is headed for (unused here)."""
+    with Image.open(path) as img:
+        img.load()
+        return img.convert('RGBA')
+
+class ProxyCache:
+    """Preview-resolution decodes of sources, LRU-evicted past `budget` bytes."""
+    def __init__(self, budget=256 * 2**20, max_side=2048):
+        self.budget = budget
+        self.max_side = max_side
+        self.entries = OrderedDict()
+        self.colors = {}  # path -> average colour of every source proxied so far; outlives evicted proxies
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def peek(self, path):
+        """The cached proxy of `path` at whatever size, or None; never decodes."""
+        key = MetadataCache.key(path)
+        with self.lock:
+            return self.entries.get(key)
+
+    def color(self, path):
+        """Average colour of `path` when it was last proxied (not re-validated: only for stand-ins)."""
+        return self.colors.get(path)
+
+    def get(self, path, size):
+        key = MetadataCache.key(path)
+        need = min(max(64, 1 << (max(size) - 1).bit_length()), self.max_side)
+        with self.lock:
+            proxy = self.entries.get(key)
+            if proxy is not None:
+                self.entries.move_to_end(key)
+                if max(proxy.size) >= need or proxy.info.get('full_size'):
+                    return proxy
+        proxy = self._build(path, need)
+        with self.lock:
+            self.colors[path] = proxy.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= self._cost(old)
+            self.entries[key] = proxy
+            self.bytes += self._cost(proxy)
+            while self.bytes > self.budget and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= self._cost(evicted)
+        return proxy
+
+    @staticmethod
+    def _build(path, side):
+        with Image.open(path) as img:
+            full_size = max(img.size) <= side
+            img.thumbnail((side, side), Image.Resampling.BILINEAR, reducing_gap=2.0)
+            proxy = img.convert('RGBA')
+        proxy.info['full_size'] = full_size
+        return proxy
+
+    @staticmethod
+    def _cost(img):
+        return img.width * img.height * 4
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.colors.clear()
+            self.bytes = 0
+
+PROXY_CACHE = ProxyCache()
+
+def preview_placeholder(path, tile):
+    """Stand-in for a tile still decoding: a cached proxy stretched to size, its average colour, or grey."""
+    if tile.rw * tile.rh >= 4096:  # below ~64x64 the colour is as good and far cheaper
+        proxy = PROXY_CACHE.peek(path)
+        if proxy is not None:
+            return render_tile(proxy.resize((tile.rw, tile.rh), Image.Resampling.NEAREST), tile)
+    return PROXY_CACHE.color(path) or ((200, 200, 200, 255) if tile.index % 2 else (215, 215, 215, 255))
+
+def paint(canvas, draw, layout, tile, img):
+    """Blit a rendered tile, or draw a flat colour stand-in without building a tile-sized image."""
+    if isinstance(img, Image.Image):
+        blit(canvas, layout, tile, img)
+        return
+    x, y = tile.x, tile.y
+    left, top = max(0, tile.ox), max(0, tile.oy)
+    right, bottom = min(tile.w, tile.ox + tile.rw), min(tile.h, tile.oy + tile.rh)
+    if tile.fill is not None and (left, top, right, bottom) != (0, 0, tile.w, tile.h):
+        draw.rectangle((x, y, x + tile.w - 1, y + tile.h - 1), fill=tile.fill)
+    if right > left and bottom > top:
+        draw.rectangle((x + left, y + top, x + right - 1, y + bottom - 1), fill=img)
+
+def sketch_layout(sources, layout):
+    """`layout` drawn with preview placeholders only; nothing is decoded."""
+    canvas = Image.new('RGBA', (layout.width, layout.height), layout.background)
+    draw = ImageDraw.Draw(canvas)
+    for tile in layout.tiles:
+        paint(canvas, draw, layout, tile, preview_placeholder(sources[tile.index], tile))
+    return canvas
+
+def provisional_dims(infos):
+    """Sizes for a layout while some headers (None) are unprobed: the median known size, else 800x600."""
+    known = sorted((info.width, info.height) for info in infos if info is not None and not info.error)
+    guess = known[len(known) // 2] if known else (800, 600)
+    return [(info.width, info.height) if info is not None and not info.error else guess for info in infos]
+
+def render_tile(img, tile):
+    """Resize a decoded source for `tile` and return the w x h box as it should land on the canvas."""
+    if img.size != (tile.rw, tile.rh):
+        img = img.resize((tile.rw, tile.rh), Image.Resampling.LANCZOS)
+    left, top = max(0, -tile.ox), max(0, -tile.oy)
+    right, bottom = min(tile.rw, tile.w - tile.ox), min(tile.rh, tile.h - tile.oy)
+    if (left, top, right, bottom) != (0, 0, tile.rw, tile.rh):
+        img = img.crop((left, top, right, bottom))
+    if tile.fill is None and img.size == (tile.w, tile.h):
+        return img
+    box = Image.new('RGBA', (tile.w, tile.h), tile.fill or TRANSPARENT)
+    if right > left and bottom > top:
+        box.alpha_composite(img, (tile.ox + left, tile.oy + top))
+    if tile.label:
+        draw_label(box, tile)
+    return box
+
+def draw_label(img, tile, y=0):
+    """Centre `tile.label` in the strip below the picture; `img` holds the tile's rows from `y` down."""
+    strip = tile.h - tile.rh
+    try:
+        font = ImageFont.load_default(max(8, strip - 4))
+    except TypeError:  # Pillow < 10.1 has a single fixed-size bitmap font
+        font = ImageFont.load_default()
+    draw = ImageDraw.Draw(img)
+    left, top, right, bottom = draw.textbbox((0, 0), tile.label, font=font)
+    draw.text(((tile.w - right - left) // 2, tile.rh + (strip - bottom - top) // 2 - y), tile.label,
+              fill=(0, 0, 0, 255), font=font)
+
+def blit(canvas, layout, tile, rendered):
+    if layout.composite:
+        canvas.alpha_composite(rendered, (tile.x, tile.y))
+    else:
+        canvas.paste(rendered, (tile.x, tile.y))
+
+def scale_layout(layout, factor):
+    """Shrink a layout by `factor`, keeping neighbouring tiles edge to edge."""
+    def span(start, length):
+        a = int(start * factor)
+        return a, max(1, int((start + length) * factor) - a)
+    tiles = []
+    for t in layout.tiles:
+        x, w = span(t.x, t.w)
+        y, h = span(t.y, t.h)
+        rw, rh = max(1, int(t.rw * factor + 0.5)), max(1, int(t.rh * factor + 0.5))
+        tiles.append(Tile(t.index, x, y, w, h, rw, rh, int(t.ox * factor), int(t.oy * factor), t.fill, t.label))
+    return layout._replace(width=max(1, int(layout.width * factor)), height=max(1, int(layout.height * factor)),
+                           tiles=tiles)
+
+def fit_layout(layout, fit):
+    """Shrink `layout` to fit the (w, h) box in quarter-octave steps, so tile sizes rarely change."""
+    if layout.width <= fit[0] and layout.height <= fit[1]:
+        return layout
+    factor = min(fit[0] / layout.width, fit[1] / layout.height)
+    return scale_layout(layout, 2 ** (math.floor(math.log2(factor) * 4) / 4))
+
+def layout_for(sources, s, preview=False, dims=None, fit=None):
+    dims = dims or get_dimensions(sources)
+    unreadable = [p for p, (w, h) in zip(sources, dims) if w <= 0 or h <= 0]
+    if unreadable:
+        raise ValueError(f"Cannot read image: {unreadable[0]}")
+    layout = plan_layout(dims, s, preview, names=sources)
+    if layout is None:
+        raise ValueError(f"The built-in engine does not support {s['mode']} mode")
+    return fit_layout(layout, fit) if fit else layout
+
+def render_tiles(sources, tiles, loader=load_source, workers=0, check=None, depth=2):
+    """Yield (tile, rendered box) in order from a thread pool, at most `depth` tiles per worker in flight."""
+    op = TRACER.current()
+
+    def work(tile):
+        with TRACER.span('decode', op=op):
+            img = loader(sources[tile.index], (tile.rw, tile.rh))
+        with TRACER.span('resize', op=op):
+            return render_tile(img, tile)
+    workers = workers or os.cpu_count() or 1
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = deque()
+        for tile in tiles:
+            if check:
+                check()
+            pending.append((tile, pool.submit(work, tile)))
+            if len(pending) >= depth * workers:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def compose(sources, s, preview=False, dims=None, loader=load_source, workers=0, fit=None):
+    """Composite `sources` in-process into an RGBA canvas, optionally shrunk to `fit` first."""
+    with TRACER.span('layout'):
+        layout = layout_for(sources, s, preview, dims, fit)
+    with TRACER.span('render', tiles=len(layout.tiles)):
+        canvas = Image.new('RGBA', (layout.width, layout.height), layout.background)
+        for tile, rendered in render_tiles(sources, layout.tiles, loader, workers):
+            blit(canvas, layout, tile, rendered)
+    return canvas
+
+class IncrementalCompositor:
+    """Keeps the last layout, canvas and rendered tiles, so a new layout only redoes what changed."""
+    def __init__(self, loader=load_source):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.layout = None
+            self.canvas = None
+            self.placed = set()
+            self.rendered = {}
+
+    @staticmethod
+    def tile_key(sources, tile):
+        return (sources[tile.index], tile.w, tile.h, tile.rw, tile.rh, tile.ox, tile.oy, tile.fill)
+
+    def render(self, sources, layout, workers=0, check=None, placeholder=None, progress=None, interval=0.1):
+        """Bring the canvas up to date with `layout`, placeholders first; returns a copy."""
+        with self.lock:
+            keys = {tile: self.tile_key(sources, tile) for tile in layout.tiles}
+            placed = {(key, tile.x, tile.y) for tile, key in keys.items()}
+
+            old = self.layout
+            if old is None or (old.background, old.composite) != (layout.background, layout.composite):
+                self.canvas = Image.new('RGBA', (layout.width, layout.height), layout.background)
+                self.placed = set()
+            elif (old.width, old.height) != (layout.width, layout.height):
+                grown = Image.new('RGBA', (layout.width, layout.height), layout.background)
+                grown.paste(self.canvas, (0, 0))
+                self.canvas = grown
+            # placeholders are recorded with a None source, so they are always cleared here
+            for key, x, y in self.placed - placed:
+                self.canvas.paste(layout.background, (x, y, x + key[1], y + key[2]))
+            self.placed &= placed
+            self.layout = layout
+            todo = [tile for tile, key in keys.items() if (key, tile.x, tile.y) not in self.placed]
+            missing = [tile for tile in todo if keys[tile] not in self.rendered]
+
+            draw = ImageDraw.Draw(self.canvas)
+
+            def place(tile, img, key):
+                paint(self.canvas, draw, layout, tile, img)
+                self.placed.add((key, tile.x, tile.y))
+
+            for tile in todo:
+                if keys[tile] in self.rendered:
+                    place(tile, self.rendered[keys[tile]], keys[tile])
+            if placeholder:
+                with TRACER.span('placeholders', tiles=len(missing)):
+                    for tile in missing:
+                        place(tile, placeholder(sources[tile.index], tile), (None,) + keys[tile][1:])
+            if progress:
+                progress(self.canvas.copy())
+            last = time.perf_counter()
+            for tile, img in render_tiles(sources, missing, self.loader, workers, check):
+                key = keys[tile]
+                self.rendered[key] = img
+                stand_in = ((None,) + key[1:], tile.x, tile.y)
+                if stand_in in self.placed:
+                    self.placed.discard(stand_in)
+                    self.canvas.paste(layout.background, (tile.x, tile.y, tile.x + tile.w, tile.y + tile.h))
+                place(tile, img, key)
+                if progress and time.perf_counter() - last >= interval:
+                    progress(self.canvas.copy())
+                    last = time.perf_counter()
+            # keep only the pixels the current layout uses, so memory tracks the canvas size
+            self.rendered = {key: self.rendered[key] for key in keys.values()}
+            return self.canvas.copy()
+
+def save_image(img, output_path, s, preview=False):
+    """Encode like the magick commands do: by file extension, 4:4:4 JPEG with alpha dropped."""
+    fmt = os.path.splitext(output_path)[1].lower().lstrip('.')
+    if fmt in ['jpg', 'jpeg']:
+        img.convert('RGB').save(output_path, 'JPEG', quality=85 if preview else s['quality'], subsampling=0)
+    elif fmt == 'webp':
+        img.save(output_path, 'WEBP', quality=75)  # build_command leaves webp at ImageMagick's default
+    else:
+        img.save(output_path)
+
+# --- Output variants ---------------------------------------------------------------
+
+# One extra encoding of a merge. At most one of quality / max_bytes / min_ssim drives it: a fixed
+# quality, or the best quality that stays under max_bytes, or the lowest whose SSIM reaches min_ssim.
+Variant = namedtuple('Variant', 'format quality max_bytes min_ssim label')
+
+VARIANT_SPEC = re.compile(r'^(?P<fmt>jpe?g|png|webp|gif)(?::(?:(?P<ssim>0?\.\d+)|(?P<size>\d+(?:\.\d+)?)(?P<unit>[km])i?b?'
+                          r'|(?P<quality>\d+)))?$', re.IGNORECASE)
+
+def parse_variants(spec, quality=DEFAULT_SETTINGS['quality']):
+    """Parse 'variants': comma-separated webp:80 (quality), jpg:500k (size), webp:0.98 (SSIM) or a bare format."""
+    variants = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        match = VARIANT_SPEC.match(item)
+        if not match:
+            raise ValueError(f"Bad variant {item!r}: expected e.g. webp:80, jpg:500k or webp:0.98")
+        fmt = match['fmt'].lower().replace('jpeg', 'jpg')
+        if (match['size'] or match['ssim']) and fmt not in ('jpg', 'webp'):
+            raise ValueError(f"Bad variant {item!r}: only jpg and webp have a quality to search")
+        max_bytes = int(float(match['size']) * 1024 ** (1 if match['unit'].lower() == 'k' else 2)) if match['size'] else 0
+        q = max(1, min(100, int(match['quality']))) if match['quality'] else quality
+        label = (f"{match['size']}{match['unit'].lower()}" if max_bytes else f"ssim{float(match['ssim'])}"
+                 if match['ssim'] else f"q{q}" if match['quality'] else "")
+        variants.append(Variant(fmt, q, max_bytes, float(match['ssim'] or 0), label))
+    return variants
+
+def variant_path(output_path, variant):
+    """'sheet.jpg' + webp:80 -> 'sheet.q80.webp'; a bare format only swaps the extension."""
+    stem, ext = os.path.splitext(output_path)
+    label = variant.label or (f"q{variant.quality}" if ext.lower().lstrip('.') == variant.format else "")
+    return f"{stem}.{label}.{variant.format}" if label else f"{stem}.{variant.format}"
+
+def encode_image(img, fmt, quality):
+    """Encode to bytes like save_image, but at an explicit quality for webp too."""
+    buf = io.BytesIO()
+    if fmt == 'jpg':
+        img.convert('RGB').save(buf, 'JPEG', quality=quality, subsampling=0)
+    elif fmt == 'webp':
+        img.save(buf, 'WEBP', quality=quality)
+    else:
+        img.save(buf, Image.registered_extensions().get(f".{fmt}", fmt.upper()))
+    return buf.getvalue()
+
+class SSIMReference:
+    """Block SSIM of encodings against one composite, on luma flattened onto white."""
+    C1, C2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+
+    def __init__(self, img, block=8, max_pixels=16 * 2**20):
+        self.block = block
+        self.factor = max(1, math.ceil(math.sqrt(img.width * img.height / max_pixels)))
+        self.x = self._luma(img)
+        self.mx = self.x.reduce(block)
+        self.xx = ImageMath.lambda_eval(lambda a: a['x'] * a['x'], x=self.x).reduce(block)
+
+    def _luma(self, img):
+        if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+            img = Image.alpha_composite(Image.new('RGBA', img.size, 'white'), img.convert('RGBA'))
+        luma = img.convert('L')
+        return (luma.reduce(self.factor) if self.factor > 1 else luma).convert('F')
+
+    def score(self, img):
+        y = self._luma(img)
+        b = self.block
+        my = y.reduce(b)
+        yy = ImageMath.lambda_eval(lambda a: a['y'] * a['y'], y=y).reduce(b)
+        xy = ImageMath.lambda_eval(lambda a: a['x'] * a['y'], x=self.x, y=y).reduce(b)
+        c1, c2 = self.C1, self.C2
+        ssim = ImageMath.lambda_eval(
+            lambda a: (2 * a['mx'] * a['my'] + c1) * (2 * (a['xy'] - a['mx'] * a['my']) + c2)
+            / ((a['mx'] * a['mx'] + a['my'] * a['my'] + c1)
+               * (a['xx'] - a['mx'] * a['mx'] + a['yy'] - a['my'] * a['my'] + c2)),
+            mx=self.mx, my=my, xx=self.xx, yy=yy, xy=xy)
+        return ssim.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+
+def encode_variant(img, variant, reference=None):
+    """Encode `img` as `variant`; returns (bytes, quality, SSIM or None, attempts)."""
+    attempts = {}
+
+    def attempt(q):
+        if q not in attempts:
+            with TRACER.span('encode', format=variant.format, quality=q):
+                attempts[q] = encode_image(img, variant.format, q)
+        return attempts[q]
+
+    scores = {}
+
+    def score(q):
+        if q not in scores:
+            data = attempt(q)
+            with TRACER.span('ssim', format=variant.format, quality=q), Image.open(io.BytesIO(data)) as encoded:
+                scores[q] = reference.score(encoded)
+        return scores[q]
+
+    q = variant.quality
+    if variant.max_bytes:
+        lo, hi, q = 1, 100, 1
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if len(attempt(mid)) <= variant.max_bytes:
+                q, lo = mid, mid + 1
+            else:
+                hi = mid - 1
+    elif variant.min_ssim:
+        lo, hi, q = 1, 100, 100
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if score(mid) >= variant.min_ssim:
+                q, hi = mid, mid - 1
+            else:
+                lo = mid + 1
+    return attempt(q), q, scores.get(q), len(attempts)
+
+def merge_variants(sources, s, output_path, workers=0):
+    """Composite once, then encode the output and every variant in parallel; returns one report each."""
+    if s.get('animate', "off") != "off" or s.get('engine') == "stream":
+        raise ValueError("Variants need an in-memory composite: use the ImageMagick or built-in engine without animation")
+    ext = os.path.splitext(output_path)[1].lower().lstrip('.').replace('jpeg', 'jpg')
+    # the main output encodes like save_image: webp stays at ImageMagick's default quality
+    main = Variant(ext, 75 if ext == 'webp' else int(s['quality']), 0, 0.0, "")
+    variants = parse_variants(s.get('variants', ""), int(s['quality']))
+    loader = PIXEL_CACHE.get if s.get('pixel_cache') else load_source
+    img = compose(sources, s, loader=loader)
+    reference = None
+    if any(v.min_ssim for v in variants):
+        with TRACER.span('ssim'):
+            reference = SSIMReference(img)
+    op = TRACER.current()
+
+    def work(path, variant):
+        with TRACER.bind(op):
+            start = time.perf_counter()
+            data, quality, ssim, attempts = encode_variant(img, variant, reference)
+            seconds = time.perf_counter() - start
+            with TRACER.span('write', bytes=len(data)):
+                with open(path, 'wb') as f:
+                    f.write(data)
+        report = {'output': path, 'format': variant.format, 'quality': quality, 'bytes': len(data),
+                  'seconds': round(seconds, 4), 'attempts': attempts}
+        if ssim is not None:
+            report['ssim'] = round(ssim, 5)
+        if variant.max_bytes and len(data) > variant.max_bytes:
+            report['note'] = f"over the {variant.max_bytes // 1024} KiB target even at quality 1"
+        return report
+
+    todo = [(output_path, main)] + [(variant_path(output_path, v), v) for v in variants]
+    with ThreadPoolExecutor(max_workers=workers or min(len(todo), os.cpu_count() or 1)) as pool:
+        return list(pool.map(lambda item: work(*item), todo))
+
+def format_variant(report):
+    detail = f"{report['format']} q{report['quality']}: {report['bytes'] / 1024:.0f} KiB in {report['seconds']:.2f}s"
+    if report['attempts'] > 1:
+        detail += f" ({report['attempts']} tries"
+        detail += f", SSIM {report['ssim']:.4f})" if 'ssim' in report else ")"
+    return detail + (f" - {report['note']}" if 'note' in report else "")
+
+# --- Preview scheduling ------------------------------------------------------------
+
+class Cancelled(Exception):
+    """Raised inside a preview render that a newer request has superseded."""
+
+class PreviewTask:
+    def __init__(self, fn, args):
+        self.fn, self.args = fn, args
+        self.event = threading.Event()
+
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+    def cancel(self):
+        self.event.set()
+
+class PreviewScheduler:
+    """One worker thread rendering only the newest preview request; submit() cancels the active one."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = None
+        self.active = None
+        self.coalesced = 0
+        self.last_render_time = None
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    @property
+    def queue_depth(self):
+        with self.cond:
+            return (self.pending is not None) + (self.active is not None)
+
+    def submit(self, fn, *args):
+        """Schedule fn(task, *args) in place of whatever is queued or running."""
+        task = PreviewTask(fn, args)
+        with self.cond:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = task
+            if self.active is not None:
+                self.active.cancel()
+            self.cond.notify()
+        return task
+
+    def cancel(self):
+        with self.cond:
+            self.pending = None
+            if self.active is not None:
+                self.active.cancel()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                task, self.pending = self.pending, None
+                self.active = task
+            start = time.perf_counter()
+            try:
+                task.fn(task, *task.args)
+            except Cancelled:
+                pass
+            except Exception:
+                # a failed render must not take the only preview thread down with it
+                logging.getLogger("ImageMerger").exception("Preview render failed")
+            finally:
+                with self.cond:
+                    self.active = None
+                    if not task.cancelled():
+                        self.last_render_time = time.perf_counter() - start
+
+# --- Streaming engine --------------------------------------------------------------
+
+class PNGStreamWriter:
+    """Writes an 8-bit RGB(A) PNG a band of scanlines at a time, so the image never sits in memory whole."""
+    def __init__(self, path, width, height, alpha=True, level=6):
+        self.file = open(path, 'wb')
+        self.stride = width * (4 if alpha else 3)
+        self.compressor = zlib.compressobj(level)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6 if alpha else 2, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.file.write(struct.pack('>I', len(data)) + tag + data)
+        self.file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write_rows(self, data):
+        view = memoryview(data)
+        out = []
+        for i in range(0, len(view), self.stride):
+            # every scanline is prefixed with its filter type; 0 = none
+            out.append(self.compressor.compress(b'\0'))
+            out.append(self.compressor.compress(view[i:i + self.stride]))
+        out = b''.join(out)
+        if out:
+            self._chunk(b'IDAT', out)
+
+    def write_image(self, img):
+        """Write the rows of an RGBA image a slice at a time, so they are never all copied at once."""
+        rows = max(1, STREAM_SLICE // (img.width * 4))
+        for y in range(0, img.height, rows):
+            part = img.crop((0, y, img.width, min(img.height, y + rows)))
+            self.write_rows(part.tobytes() if self.stride == img.width * 4 else part.convert('RGB').tobytes())
+
+    def close(self):
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.file.close()
+
+def with_limits(cmd, limits):
+    """Insert ImageMagick -limit options (e.g. {'memory': '512MiB'}) right after the program name."""
+    at = 2 if cmd[1:2] == ['montage'] else 1
+    opts = [arg for name, value in limits.items() for arg in ('-limit', name, str(value))]
+    return cmd[:at] + opts + cmd[at:]
+
+def memory_limits(budget_mb):
+    # past `memory` the pixel cache goes to memory-mapped files, past `map` to plain disk
+    return {'memory': f"{budget_mb}MiB", 'map': f"{2 * budget_mb}MiB"}
+
+STREAM_SLICE = 1 << 22  # bytes of pixels the streaming engine copies at a time
+
+def reduction(w, h, rw, rh):
+    """Integer factor a w x h source can shrink by before resizing to rw x rh and stay at least twice as big."""
+    return max(1, min(w // (2 * rw), h // (2 * rh)))
+
+def load_reduced(path, size):
+    """Loader for merge_streaming: the first frame of `path` in its own mode, no more than needed for `size`."""
+    with Image.open(path) as img:
+        img.draft(None, (2 * size[0], 2 * size[1]))  # JPEG decodes straight at 1/2, 1/4 or 1/8 scale
+        img.load()
+        factor = reduction(img.width, img.height, *size)
+        if factor == 1:
+            return img
+        if img.mode in ('P', '1', 'I;16'):  # modes reduce() can't handle
+            return img.convert('RGBA').reduce(factor)
+        return img.reduce(factor)
+
+def decode_bytes(info, size, reduce=True):
+    """Upper bound on what decoding one source for a `size` tile and preparing it to resize holds at once."""
+    w, h = info.width, info.height
+    if reduce and info.format == 'JPEG':  # the draft() in load_reduced
+        scale = next(s for s in (8, 4, 2, 1) if s <= min(w // (2 * size[0]), h // (2 * size[1])) or s == 1)
+        w, h = -(-w // scale), -(-h // scale)
+    # a decode and one RGBA copy (converted, premultiplied or reduced) of up to 4 bytes a pixel each;
+    # Pillow's WebP decoder keeps two canvases of its own and passes the frame through bytes as well
+    return (16 if info.format == 'WEBP' else 8) * w * h
+
+def render_strips(img, tile, rows):
+    """render_tile for one source, yielded `rows` scanlines at a time and resized strip by strip."""
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA')
+    scale = img.size != (tile.rw, tile.rh)
+    if scale and img.mode == 'RGBA':
+        img = img.convert('RGBa')  # what Image.resize does for RGBA on every call; do it once
+    sx, sy = img.width / tile.rw, img.height / tile.rh
+    left, top = max(0, -tile.ox), max(0, -tile.oy)
+    right, bottom = min(tile.rw, tile.w - tile.ox), min(tile.rh, tile.h - tile.oy)
+    for y in range(0, tile.h, rows):
+        h = min(rows, tile.h - y)
+        a, b = max(top, y - tile.oy), min(bottom, y + h - tile.oy)  # rows of the resized picture in this strip
+        piece = None
+        if b > a and right > left:
+            if scale:
+                piece = img.resize((right - left, b - a), Image.Resampling.LANCZOS,
+                                   box=(left * sx, a * sy, right * sx, b * sy))
+            else:
+                piece = img.crop((left, a, right, b))
+            if piece.mode != 'RGBA':
+                piece = piece.convert('RGBA')
+        if tile.fill is None and not tile.label and piece is not None and piece.size == (tile.w, h):
+            yield piece
+            continue
+        strip = Image.new('RGBA', (tile.w, h), tile.fill or TRANSPARENT)
+        if piece is not None:
+            strip.alpha_composite(piece, (tile.ox + left, tile.oy + a - y))
+        if tile.label and y + h > tile.rh:
+            draw_label(strip, tile, y)
+        yield strip
+
+def streaming_memory(infos, layout, budget, reduce=True):
+    """(decode workers, band rows, peak bytes) for merge_streaming; the peak bounds pixel memory, not the interpreter."""
+    decode = max(decode_bytes(infos[t.index], (t.rw, t.rh), reduce) for t in layout.tiles)
+    worker = decode + 4 * STREAM_SLICE  # a resized strip, its RGBA and canvas copies, and its bytes
+    workers = max(1, min(os.cpu_count() or 1, budget // worker))
+    # the band, a tile's rows read back from the spill, and a slice being encoded (crop, RGB copy, bytes)
+    band_rows = max(1, min(layout.height, (budget - 3 * STREAM_SLICE) // (layout.width * 8)))
+    return workers, band_rows, max(workers * worker, band_rows * layout.width * 8 + 3 * STREAM_SLICE)
+
+def pin_mmap_threshold(size=1 << 20):
+    """Have glibc mmap every allocation of `size` bytes and up, so a freed decode goes straight back to the OS."""
+    # left alone, glibc raises the threshold past the first big block freed, and later decodes then
+    # fragment the heap: RSS creeps 10% or more above what is live
+    if sys.platform.startswith('linux'):
+        try:
+            ctypes.CDLL(None).mallopt(-3, size)  # M_MMAP_THRESHOLD
+        except (AttributeError, OSError):
+            pass
+
+def merge_streaming(sources, s, output_path, timeout=600):
+    """Merge through a scratch file and a banded PNG writer, never holding the output canvas in memory."""
+    budget_mb = s.get('memory_budget') or 512
+    infos = META_CACHE.get_many(sources)
+    layout = layout_for(sources, s, dims=[(i.width, i.height) for i in infos])
+    fmt = os.path.splitext(output_path)[1].lower().lstrip('.')
+    alpha = fmt == 'png'
+    workers, band_rows, _ = streaming_memory(infos, layout, budget_mb * 2**20, not s.get('pixel_cache'))
+    loader = PIXEL_CACHE.get if s.get('pixel_cache') else load_reduced
+    op = TRACER.current()
+    pin_mmap_threshold()
+
+    with tempfile.TemporaryDirectory(prefix="imagemerger-stream-") as tmp:
+        spill_path = os.path.join(tmp, 'tiles.raw')
+        offsets, end = {}, 0
+        for tile in layout.tiles:
+            offsets[tile], end = end, end + tile.w * tile.h * 4
+
+        def spill_tile(tile):
+            with TRACER.span('decode', op=op):
+                # no reference kept here: render_strips drops the decode once it has converted it
+                strips = render_strips(loader(sources[tile.index], (tile.rw, tile.rh)), tile,
+                                       max(1, STREAM_SLICE // (tile.w * 4)))
+            with TRACER.span('resize', op=op), open(spill_path, 'r+b') as f:
+                f.seek(offsets[tile])
+                for strip in strips:
+                    f.write(strip.tobytes())
+
+        with open(spill_path, 'w+b') as spill:
+            spill.truncate(end)
+            with TRACER.span('spill', tiles=len(layout.tiles), workers=workers):
+                pool = ThreadPoolExecutor(max_workers=workers)
+                try:
+                    for _ in pool.map(spill_tile, layout.tiles):
+                        pass
+                finally:
+                    pool.shutdown(wait=True, cancel_futures=True)
+
+            target = output_path if fmt == 'png' else os.path.join(tmp, 'merged.png')
+            tiles = sorted(layout.tiles, key=lambda t: t.y)
+            with TRACER.span('assemble', band_rows=band_rows), \
+                    PNGStreamWriter(target, layout.width, layout.height, alpha) as writer:
+                for top in range(0, layout.height, band_rows):
+                    bottom = min(layout.height, top + band_rows)
+                    band = Image.new('RGBA', (layout.width, bottom - top), layout.background)
+                    for tile in tiles:
+                        if tile.y >= bottom:
+                            break
+                        a, b = max(top, tile.y), min(bottom, tile.y + tile.h)
+                        if a >= b:
+                            continue
+                        spill.seek(offsets[tile] + (a - tile.y) * tile.w * 4)
+                        data = spill.read((b - a) * tile.w * 4)
+                        part = Image.frombuffer('RGBA', (tile.w, b - a), data, 'raw', 'RGBA', 0, 1)
+                        if layout.composite:
+                            band.alpha_composite(part, (tile.x, a - top))
+                        else:
+                            band.paste(part, (tile.x, a - top))
+                        del part, data
+                    writer.write_image(band)
+                    del band
+
+        if fmt != 'png':
+            cmd = ['magick', '-quiet', target]
+            if fmt in ['jpg', 'jpeg']:
+                cmd.extend(['-sampling-factor', '4:4:4', '-quality', str(s['quality'])])
+            cmd = with_limits(cmd + [output_path.replace('\\', '/')], memory_limits(budget_mb))
+            result = run_magick(cmd, timeout=timeout)
+            if result.returncode != 0:
+                raise RuntimeError(f"ImageMagick error: {result.stderr.strip() or 'unknown error'}")
+
+# --- Resource governor --------------------------------------------------------------
+
+def detect_resources():
+    """(usable cores, bytes of memory available) for this process, best effort on each platform."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            memory = next(int(line.split()[1]) * 1024 for line in f if line.startswith('MemAvailable:'))
+    except (OSError, StopIteration):
+        pass
+    if memory is None and os.name == 'nt':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('length', ctypes.c_ulong), ('load', ctypes.c_ulong)] + [(name, ctypes.c_ulonglong) for name in
+                        ('total', 'available', 'page_total', 'page_free', 'virtual_total', 'virtual_free', 'extended')]
+        status = MemoryStatus(length=ctypes.sizeof(MemoryStatus))
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            memory = status.available
+    if memory is None:
+        try:
+            memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            memory = 4 * 2**30
+    try:  # a container's cgroup limit is what actually gets enforced
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    except OSError:
+        pass
+    return cores, memory
+
+def estimate_memory(sources, s, dims=None):
+    """Rough peak bytes a merge of `sources` needs, for admission; errs on the high side."""
+    dims = dims or get_dimensions(sources)
+    pixels = sum(w * h for w, h in dims)
+    largest = max((w * h for w, h in dims), default=0)
+    engine = s.get('engine', "magick")
+    if s.get('memory_budget'):
+        return s['memory_budget'] * 2**20 + largest * 8
+    if engine == "stream":
+        return 512 * 2**20 + largest * 8
+    if engine == "pillow" or s.get('animate', "off") != "off":
+        return pixels * 4 + largest * 8  # RGBA canvas, plus a decode and its resize in flight
+    return pixels * 16  # ImageMagick holds every source and the output at 8 bytes per pixel (Q16 RGBA)
+
+Grant = namedtuple('Grant', 'memory limits env')
+
+class ResourceGovernor:
+    """Admits jobs while their memory estimates fit and grants each its share as magick -limit values."""
+    def __init__(self, cores=0, memory=0, jobs=1, tmpdir=None, share=0.75):
+        self.cores, self.memory = cores, memory
+        self.jobs = jobs
+        self.tmpdir = tmpdir
+        self.share = share  # of the available memory that merges may reserve
+        self.cond = threading.Condition()
+        self.reserved = 0
+        self.running = 0
+        self.local = threading.local()
+
+    def budget(self):
+        if not self.cores or not self.memory:
+            cores, memory = detect_resources()
+            self.cores, self.memory = self.cores or cores, self.memory or int(memory * self.share)
+        return self.memory
+
+    def current(self):
+        return getattr(self.local, 'grant', None)
+
+    @contextmanager
+    def bind(self, grant):
+        """Apply `grant` to run_magick calls on this thread too (see split)."""
+        previous, self.local.grant = self.current(), grant
+        try:
+            yield grant
+        finally:
+            self.local.grant = previous
+
+    @staticmethod
+    def split(grant, parts):
+        """Divide one job's grant between `parts` magick processes running side by side."""
+        memory = max(64 * 2**20, grant.memory // parts)
+        limits = dict(grant.limits, thread=max(1, grant.limits['thread'] // parts), memory=f"{memory // 2**20}MiB",
+                      map=f"{2 * memory // 2**20}MiB")
+        return grant._replace(memory=memory, limits=limits)
+
+    @contextmanager
+    def admit(self, need):
+        budget = self.budget()
+        memory = max(64 * 2**20, min(need, budget))
+        start = time.perf_counter()
+        with self.cond:
+            while self.running and self.reserved + memory > budget:
+                self.cond.wait()
+            self.reserved += memory
+            self.running += 1
+        waited = time.perf_counter() - start
+        if waited > 0.01:
+            TRACER.record('queue', start, waited, TRACER.current())
+        tmpdir = self.tmpdir or tempfile.gettempdir()
+        os.makedirs(tmpdir, exist_ok=True)
+        scratch = tempfile.mkdtemp(prefix="imagemerger-magick-", dir=tmpdir)
+        jobs = max(1, self.jobs)
+        limits = {'thread': max(1, self.cores // jobs), 'memory': f"{memory // 2**20}MiB",
+                  'map': f"{2 * memory // 2**20}MiB",
+                  'disk': f"{max(256, int(shutil.disk_usage(scratch).free * 0.8) // jobs // 2**20)}MiB"}
+        self.local.grant = Grant(memory, limits, {'MAGICK_TMPDIR': scratch})
+        try:
+            yield self.local.grant
+        finally:
+            self.local.grant = None
+            shutil.rmtree(scratch, ignore_errors=True)
+            with self.cond:
+                self.reserved -= memory
+                self.running -= 1
+                self.cond.notify_all()
+
+GOVERNOR = ResourceGovernor()
+
+# --- Animated merges ---------------------------------------------------------------
+
+# One output frame: the frame index shown from every source, and for how many ms
+FrameStep = namedtuple('FrameStep', 'indices duration')
+
+def frame_durations(path):
+    """Display time of every frame of `path` in ms; a still image is a single frame of 0 ms."""
+    with Image.open(path) as img:
+        if getattr(img, 'n_frames', 1) == 1:
+            return [0]
+        durations = []
+        for i in range(img.n_frames):
+            img.seek(i)
+            if img.format == 'WEBP':
+                img.load()  # the WebP plugin only sets 'duration' when the frame is decoded
+            durations.append(img.info.get('duration') or 100)  # browsers show 0 ms frames for 100 ms
+        return durations
+
+def plan_timeline(durations, timeline="loop", delay=0, min_step=0):
+    """One timeline of FrameSteps as long as the longest animation; shorter ones loop, hold or stretch."""
+    animated = [d for d in durations if len(d) > 1]
+    if not animated:
+        return [FrameStep((0,) * len(durations), 0)]
+    total = max(sum(d) for d in animated)
+    starts = [[sum(d[:i]) for i in range(len(d))] if len(d) > 1 else [0] for d in durations]
+    lengths = [sum(d) for d in durations]
+
+    def local_time(i, t):
+        if len(durations[i]) == 1:
+            return 0
+        if timeline == "stretch":
+            return t * lengths[i] / total
+        if timeline == "hold":
+            return min(t, lengths[i] - 1)
+        return t % lengths[i]
+
+    if delay:
+        times = list(range(0, total, delay))
+    else:
+        points = set()
+        for i, d in enumerate(durations):
+            if len(d) == 1:
+                continue
+            if timeline == "stretch":
+                points.update(round(s * total / lengths[i]) for s in starts[i])
+            else:
+                repeats = range(0, total, lengths[i]) if timeline == "loop" else [0]
+                points.update(r + s for r in repeats for s in starts[i] if r + s < total)
+        times = sorted(points)
+    steps = []
+    for t, end in zip(times, times[1:] + [total]):
+        indices = tuple(bisect.bisect_right(starts[i], local_time(i, t)) - 1 for i in range(len(durations)))
+        if steps and steps[-1].indices == indices:
+            steps[-1] = steps[-1]._replace(duration=steps[-1].duration + end - t)
+        else:
+            steps.append(FrameStep(indices, end - t))
+    if min_step:
+        # a short step between longer ones is dropped and its time added to the step before; a run of
+        # short steps is thinned instead, each kept step absorbing the next ones until it is long enough
+        merged = []
+        for i, step in enumerate(steps):
+            isolated = step.duration < min_step and (i + 1 == len(steps) or steps[i + 1].duration >= min_step)
+            if merged and (merged[-1].duration < min_step or merged[-1].indices == step.indices or isolated):
+                merged[-1] = merged[-1]._replace(duration=merged[-1].duration + step.duration)
+            else:
+                merged.append(step)
+        if len(merged) > 1 and merged[-1].duration < min_step:
+            last = merged.pop()
+            merged[-1] = merged[-1]._replace(duration=merged[-1].duration + last.duration)
+        steps = merged
+    return steps
+
+def animation_frames(sources, layout, steps):
+    """Yield the composited RGBA canvas of each step, holding one frame per source."""
+    # only sources that move past their first frame keep a file open; the rest are decoded once
+    animated = {i for step in steps for i, index in enumerate(step.indices) if index}
+    handles, current = {}, {}
+    try:
+        for step in steps:
+            canvas = Image.new('RGBA', (layout.width, layout.height), layout.background)
+            for tile in layout.tiles:
+                index = step.indices[tile.index]
+                shown = current.get(tile)
+                if shown is None or shown[0] != index:
+                    with TRACER.span('decode'):
+                        if tile.index in animated:
+                            img = handles.get(tile.index)
+                            if img is None:
+                                img = handles[tile.index] = Image.open(sources[tile.index])
+                            img.seek(index)
+                            frame = img.convert('RGBA')
+                        else:
+                            frame = load_source(sources[tile.index])
+                    with TRACER.span('resize'):
+                        shown = current[tile] = (index, render_tile(frame, tile))
+                blit(canvas, layout, tile, shown[1])
+            yield canvas
+    finally:
+        for img in handles.values():
+            img.close()
+
+GIF_MIN_DELAY = 20  # ms
+
+class GIFStreamWriter:
+    """Writes an animated GIF a frame at a time; each frame gets its own 256-colour palette."""
+    def __init__(self, path, width, height, alpha=False, loop=0):
+        self.file = open(path, 'wb')
+        self.alpha = alpha
+        # no global colour table; 8 bits of colour resolution
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0x70, 0, 0))
+        self.file.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+
+    def write_frame(self, img, duration):
+        frame = img.convert('RGB').quantize(255 if self.alpha else 256)
+        # GIF delays are in 1/100 s; round rather than truncate so the total length drifts less.
+        # Browsers play delays under 20 ms as 100 ms, so plan_timeline(min_step=GIF_MIN_DELAY) avoids them.
+        params = {'duration': max(GIF_MIN_DELAY, round(duration, -1)), 'include_color_table': True}
+        if self.alpha:
+            # index 255 is kept free for transparency; disposal 2 clears each frame before the next
+            frame.paste(255, mask=img.getchannel('A').point(lambda a: 255 if a < 128 else 0))
+            params.update(transparency=255, disposal=2)
+        palette = frame.getpalette()
+        frame.putpalette(palette + [0] * (768 - len(palette)))
+        for chunk in GifImagePlugin.getdata(frame, **params):
+            self.file.write(chunk)
+
+    def close(self):
+        self.file.write(b';')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.file.close()
+
+class _FrameSequence:
+    """Feeds Pillow's animated WebP writer one frame at a time."""
+    mode = 'RGBA'
+
+    def __init__(self, frames, count):
+        self.frames = iter(frames)
+        self.n_frames = count
+        self.frame = None
+
+    def seek(self, index):
+        self.frame = next(self.frames)
+
+    @property
+    def im(self):
+        return self.frame.im
+
+    def getim(self):
+        return self.frame.getim()
+
+def merge_animated(sources, s, output_path):
+    """Merge animated GIF/WEBP sources frame by frame into an animated GIF or WEBP."""
+    fmt = os.path.splitext(output_path)[1].lower().lstrip('.')
+    if fmt not in ['gif', 'webp']:
+        raise ValueError("Animated merges are written as GIF or WEBP")
+    infos = META_CACHE.get_many(sources)
+    with TRACER.span('layout'):
+        layout = layout_for(sources, s, dims=[(i.width, i.height) for i in infos])
+    with TRACER.span('timeline'):
+        durations = [frame_durations(p) if info.frames > 1 else [0] for p, info in zip(sources, infos)]
+        steps = plan_timeline(durations, s['animate'], s.get('frame_delay') or 0,
+                              GIF_MIN_DELAY if fmt == 'gif' else 0)
+    frames = animation_frames(sources, layout, steps)
+    with TRACER.span('animate', frames=len(steps)):
+        if fmt == 'gif':
+            alpha = layout.background[3] < 255 or any(i.alpha for i in infos)
+            with GIFStreamWriter(output_path, layout.width, layout.height, alpha) as writer:
+                for step, frame in zip(steps, frames):
+                    writer.write_frame(frame, step.duration)
+        else:
+            first = next(frames)
+            rest = [_FrameSequence(frames, len(steps) - 1)] if len(steps) > 1 else []
+            first.save(output_path, 'WEBP', save_all=True, append_images=rest, loop=0, quality=75,
+                       duration=[step.duration for step in steps])
+
+# --- Output cache --------------------------------------------------------------------
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path` against other processes."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after ten seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class OutputCache:
+    """Finished merges keyed by settings, command and sources, reused as copies (LRU)."""
+    VERSION = 1
+    # settings that change how a merge runs but not its pixels
+    NEUTRAL_SETTINGS = {'cache_outputs', 'memory_budget', 'prenormalize_workers', 'pixel_cache', 'chunk_size'}
+    FLUSH_INTERVAL = 30.0  # seconds between index writes for hits and misses alone
+
+    def __init__(self, directory=os.path.join(CACHE_DIR, 'outputs'), max_bytes=2 * 2**30, hash_contents=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hash_contents = hash_contents
+        self.lock = threading.Lock()
+        self.pending = {'hits': 0, 'misses': 0, 'used': {}, 'gone': set()}
+        self.flushed = time.monotonic()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _locked(self):
+        """The index as on disk, with this process's pending lookups applied, saved on exit."""
+        with file_lock(self.directory + '.lock'):
+            try:
+                with open(os.path.join(self.directory, 'index.json'), encoding='utf-8') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {'entries': {}, 'hits': 0, 'misses': 0}
+            pending = self.pending
+            index['hits'] += pending['hits']
+            index['misses'] += pending['misses']
+            for key in pending['gone']:
+                if not os.path.isfile(self._entry(key)):  # unless another process has stored it since
+                    index['entries'].pop(key, None)
+            for key, used in pending['used'].items():
+                if key in index['entries']:
+                    index['entries'][key][1] = max(index['entries'][key][1], used)
+            self.pending = {'hits': 0, 'misses': 0, 'used': {}, 'gone': set()}
+            self.flushed = time.monotonic()
+            try:
+                yield index
+            finally:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, 'index.json')
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(index, f)
+                os.replace(path + '.tmp', path)
+
+    def key(self, sources, s, output_path):
+        ext = os.path.splitext(output_path)[1].lower()
+        h = hashlib.sha256()
+        settings = {k: v for k, v in s.items() if k not in self.NEUTRAL_SETTINGS}
+        h.update(json.dumps([self.VERSION, ext, settings], sort_keys=True).encode())
+        h.update(json.dumps(build_command(sources, s, 'OUTPUT' + ext)).encode())
+        for path in sources:
+            st = os.stat(path)
+            h.update(f"{os.path.abspath(path)}\0{st.st_size}\0".encode())
+            if self.hash_contents:
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(2**20), b''):
+                        h.update(block)
+            else:
+                h.update(str(st.st_mtime_ns).encode())
+        return h.hexdigest() + ext
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    @staticmethod
+    def _place(src, dst):
+        """Copy `src` to `dst`, replacing `dst` atomically."""
+        # never a hardlink: a later merge writing `dst` in place would rewrite the other name too
+        tmp = f"{dst}.{os.getpid()}.part"
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def fetch(self, key, output_path):
+        """Produce `output_path` from the cache; returns False on a miss."""
+        with self.lock:
+            try:
+                self._place(self._entry(key), output_path)
+            except OSError:  # never stored, or evicted by another process
+                self.pending['misses'] += 1
+                self.pending['gone'].add(key)
+                hit = False
+            else:
+                self.pending['hits'] += 1
+                self.pending['used'][key] = time.time()
+                hit = True
+            if time.monotonic() - self.flushed > self.FLUSH_INTERVAL:
+                with self._locked():
+                    pass
+            return hit
+
+    def store(self, key, output_path):
+        with self.lock, self._locked() as index:
+            path = self._entry(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._place(output_path, path)
+            index['entries'][key] = [os.path.getsize(path), time.time()]
+            total = sum(size for size, _ in index['entries'].values())
+            for old in sorted(index['entries'], key=lambda k: index['entries'][k][1]):
+                if total <= self.max_bytes or old == key:
+                    break
+                total -= index['entries'].pop(old)[0]
+                try:
+                    os.unlink(self._entry(old))
+                except OSError:
+                    pass
+
+    def flush(self):
+        """Write pending hit/miss counts and LRU times to the index."""
+        with self.lock:
+            pending = self.pending
+            if pending['hits'] or pending['misses']:
+                with self._locked():
+                    pass
+
+    def stats(self):
+        with self.lock, self._locked() as index:
+            lookups = index['hits'] + index['misses']
+            return {'entries': len(index['entries']), 'bytes': sum(size for size, _ in index['entries'].values()),
+                    'max_bytes': self.max_bytes, 'hits': index['hits'], 'misses': index['misses'],
+                    'hit_rate': index['hits'] / lookups if lookups else 0.0}
+
+    def clear(self):
+        with self.lock, file_lock(self.directory + '.lock'):
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.pending = {'hits': 0, 'misses': 0, 'used': {}, 'gone': set()}
+
+OUTPUT_CACHE = OutputCache()
+
+# --- Decoded pixel cache -------------------------------------------------------------
+
+class PixelCache:
+    """Sources decoded once to raw RGBA (or MPC for ImageMagick) files that later merges memory-map."""
+    MAGIC = b'IMRGBA1\0'
+    HEADER = struct.Struct('<8sII')
+
+    def __init__(self, directory=os.path.join(CACHE_DIR, 'pixels'), max_bytes=4 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total = None
+        self.magick_version = None
+
+    def _name(self, path):
+        key = MetadataCache.key(path)
+        if key is None:
+            raise FileNotFoundError(path)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get(self, path, size=None):
+        """Loader for render_tiles: the first frame of `path` as RGBA, mapped from the cache."""
+        raw = os.path.join(self.directory, self._name(path) + '.rgba')
+        try:
+            return self._map(raw)
+        except (OSError, ValueError):
+            pass
+        img = load_source(path)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, img.width, img.height))
+            f.write(img.tobytes())
+        os.replace(tmp, raw)
+        self._added(os.path.getsize(raw))
+        return img
+
+    def _map(self, raw):
+        with open(raw, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, width, height = self.HEADER.unpack_from(mm)
+        if magic != self.MAGIC or len(mm) != self.HEADER.size + width * height * 4:
+            raise ValueError("truncated pixel cache file")
+        os.utime(raw)  # mtime is the LRU clock
+        # frombuffer with these raw args shares the mapping; nothing is copied until pixels change
+        return Image.frombuffer('RGBA', (width, height), memoryview(mm)[self.HEADER.size:], 'raw', 'RGBA', 0, 1)
+
+    def stage_mpc(self, paths, timeout=600):
+        """Return an MPC copy of every path for ImageMagick, converting the ones not cached yet."""
+        if self.magick_version is None:
+            version = run_magick(['magick', '-version'], timeout=30).stdout.splitlines()[:1]
+            self.magick_version = hashlib.sha1(''.join(version).encode()).hexdigest()[:12]
+        directory = os.path.join(self.directory, 'mpc-' + self.magick_version)
+        os.makedirs(directory, exist_ok=True)
+        staged = [os.path.join(directory, self._name(p) + '.mpc') for p in paths]
+
+        def convert(path, mpc):
+            tmp = mpc[:-4] + f".{threading.get_ident()}.part"
+            result = run_magick(['magick', '-quiet', path.replace('\\', '/'), tmp + '.mpc'], timeout=timeout)
+            if result.returncode != 0:
+                raise RuntimeError(f"ImageMagick error: {result.stderr.strip() or 'unknown error'}")
+            # ImageMagick finds the pixels next to the header by name: move the .cache first
+            os.replace(tmp + '.cache', mpc[:-4] + '.cache')
+            os.replace(tmp + '.mpc', mpc)
+            self._added(os.path.getsize(mpc) + os.path.getsize(mpc[:-4] + '.cache'))
+
+        todo = []
+        for path, mpc in zip(paths, staged):
+            if os.path.isfile(mpc) and os.path.isfile(mpc[:-4] + '.cache'):
+                os.utime(mpc)
+            else:
+                todo.append((path, mpc))
+        if todo:
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+                list(pool.map(lambda job: convert(*job), todo))
+        return staged
+
+    def _files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.part'):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def _added(self, size):
+        with self.lock:
+            if self.total is None:
+                self.total = sum(size for _, size, _ in self._files())
+            else:
+                self.total += size
+            if self.total <= self.max_bytes:
+                return
+            # An .mpc header and its .cache share a stem and are evicted together
+            groups = {}
+            for path, size, used in self._files():
+                stem = os.path.splitext(path)[0]
+                old = groups.get(stem, (0, 0))
+                groups[stem] = (old[0] + size, max(old[1], used))
+            for stem in sorted(groups, key=lambda k: groups[k][1]):
+                if self.total <= self.max_bytes:
+                    break
+                for ext in ('.rgba', '.mpc', '.cache'):
+                    try:
+                        os.unlink(stem + ext)
+                    except OSError:
+                        pass
+                self.total -= groups[stem][0]
+
+    def stats(self):
+        files = list(self._files())
+        return {'files': len(files), 'bytes': sum(size for _, size, _ in files), 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.total = None
+
+PIXEL_CACHE = PixelCache()
+
+# --- Chunked invocation ------------------------------------------------------------
+
+# Bytes of source paths one command line may carry before they go into an @file instead; Windows
+# caps a whole command line at 32767 characters, Linux at a quarter of the stack limit (usually 2 MB)
+ARGV_LIMIT = 24000 if os.name == 'nt' else 512 * 1024
+
+def write_filelist(paths, list_path):
+    """Write `paths` for ImageMagick's @file syntax and return the '@file' argument."""
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for p in paths:
+            f.write('"' + p.replace('\\', '/').replace('"', '\\"') + '"\n')
+    return '@' + list_path.replace('\\', '/')
+
+def filelist_for(paths, directory, name='sources.txt'):
+    """An @file for `paths` when they would not fit on a command line, else None."""
+    if sum(len(p) + 1 for p in paths) <= ARGV_LIMIT:
+        return None
+    return write_filelist(paths, os.path.join(directory, name))
+
+def ashlar_args_length(sources, s):
+    """Upper bound on the command line bytes ashlar_tile_args spells out for `sources`."""
+    # 64: the fixed arguments with 6-digit sizes/offsets, separators and quoting; labels add ~100
+    per_tile = 64 + (100 if s['show_labels'] else 0)
+    return sum(per_tile + len(p) * (2 if s['show_labels'] else 1) for p in sources)
+
+def plan_chunks(sources, s, dims, workers):
+    """Source index chunks for merge_chunked, or None when one magick call will do."""
+    n, size = len(sources), s.get('chunk_size') or 0
+    if s['mode'] == "ashlar":
+        count = -(-ashlar_args_length(sources, s) // ARGV_LIMIT)
+        if size:
+            count = max(count, -(-n // size))
+        elif n > 256 and workers >= 2:
+            count = max(count, -(-n // max(64, -(-n // workers))))
+        size = -(-n // count)
+        return [list(range(i, min(n, i + size))) for i in range(0, n, size)] if count > 1 else None
+    if not size:
+        if n <= 256 or workers < 2:
+            return None
+        size = max(64, -(-n // workers))
+    if s['mode'] == "grid":
+        if s['grid_fit'] == "original":
+            return None  # montage sizes its cells from the largest image; chunks would disagree
+        cols = s['grid_cols'] or int(math.ceil(math.sqrt(n)))
+        rows = -(-n // cols)
+        step = max(1, size // cols)
+        bands = [(r * cols, min(n, (r + step) * cols)) for r in range(0, rows, step)]
+        if len(bands) > 1 and bands[-1][1] - bands[-1][0] < cols:
+            # montage narrows a lone short row to its own width; keep it with a full one
+            bands[-2:] = [(bands[-2][0], n)]
+        chunks = [list(range(a, b)) for a, b in bands]
+    else:
+        chunks = [list(range(i, min(n, i + size))) for i in range(0, n, size)]
+    return chunks if len(chunks) > 1 else None
+
+def merge_chunked(sources, s, output_path, chunks, dims, timeout=600, workers=0):
+    """Merge each chunk to a MIFF in parallel, then combine the parts in one last magick call."""
+    workers = workers or os.cpu_count() or 1
+    mode, fmt = s['mode'], s['format']
+    op, grant = TRACER.current(), GOVERNOR.current()
+    if grant:
+        grant = GOVERNOR.split(grant, min(workers, len(chunks)))
+    with tempfile.TemporaryDirectory(prefix="imagemerger-chunks-") as tmp:
+        parts = [os.path.join(tmp, f"part{i:04d}.miff").replace('\\', '/') for i in range(len(chunks))]
+        offsets = []
+        commands = []
+        if mode == "ashlar":
+            layout = plan_layout(dims, s, names=sources)
+            # bands of whole rows keep each chunk's bounding box, and so its canvas, small; a band
+            # also ends early once its arguments would overflow the command line
+            ordered = sorted(layout.tiles, key=lambda t: (t.y, t.x))
+            size = -(-len(ordered) // len(chunks))
+            bands, band, length = [], [], 0
+            for t in ordered:
+                args = ashlar_tile_args(sources[t.index].replace('\\', '/'), t)
+                cost = sum(len(a) + 3 for a in args)
+                if band and (len(band) == size or length + cost > ARGV_LIMIT):
+                    bands.append(band)
+                    band, length = [], 0
+                band.append(t)
+                length += cost
+            bands.append(band)
+            parts = [os.path.join(tmp, f"part{i:04d}.miff").replace('\\', '/') for i in range(len(bands))]
+            for tiles, part in zip(bands, parts):
+                x0, y0 = min(t.x for t in tiles), min(t.y for t in tiles)
+                x1, y1 = max(t.x + t.w for t in tiles), max(t.y + t.h for t in tiles)
+                cmd = ['magick', '-quiet', '-size', f'{x1 - x0}x{y1 - y0}', 'xc:transparent', '-depth', '8']
+                for t in tiles:
+                    cmd.extend(ashlar_tile_args(sources[t.index].replace('\\', '/'), t, x0, y0))
+                commands.append(cmd + [part])
+                offsets.append((x0, y0))
+        else:
+            # 'miff' is neither jpg nor png: no JPEG options, transparent padding, as for PNG
+            chunk_s = dict(s, format='miff', grid_cols=s['grid_cols'] or int(math.ceil(math.sqrt(len(sources)))))
+            for i, (chunk, part) in enumerate(zip(chunks, parts)):
+                paths = [sources[j] for j in chunk]
+                commands.append(build_command(paths, chunk_s, part, dims=dims,
+                                              filelist=filelist_for(paths, tmp, f"part{i:04d}.txt")))
+
+        def run(cmd):
+            with TRACER.bind(op), GOVERNOR.bind(grant):
+                result = run_magick(cmd, timeout=timeout)
+            if result.returncode != 0:
+                raise RuntimeError(f"ImageMagick error: {result.stderr.strip() or 'unknown error'}")
+
+        with TRACER.span('chunks', chunks=len(commands)):
+            with ThreadPoolExecutor(max_workers=min(workers, len(commands))) as pool:
+                list(pool.map(run, commands))
+
+        jpeg = ['-sampling-factor', '4:4:4', '-quality', str(s['quality'])] if fmt in ['jpg', 'jpeg'] else []
+        if mode == "ashlar":
+            bg = 'transparent' if layout.background == TRANSPARENT else 'white'
+            cmd = ['magick', '-quiet', '-size', f'{layout.width}x{layout.height}', f'xc:{bg}', '-depth', '8']
+            for part, (x, y) in zip(parts, offsets):
+                cmd.extend([part, '-geometry', f'+{x}+{y}', '-composite'])
+            cmd.extend(jpeg)
+        elif mode == "grid":
+            bg = 'white' if fmt in ['jpg', 'jpeg'] else 'transparent'
+            cmd = ['magick', '-quiet'] + parts + ['-background', bg, '-append'] + jpeg
+            if jpeg:
+                cmd.extend(['-alpha', 'remove', '-alpha', 'off'])
+        else:
+            cmd = ['magick', '-quiet'] + parts + ['+append' if mode == "horizontal" else '-append'] + jpeg
+        result = run_magick(cmd + [output_path.replace('\\', '/')], timeout=timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"ImageMagick error: {result.stderr.strip() or 'unknown error'}")
+
+# --- Grid pre-normalization --------------------------------------------------------
+
+def _normalize_tile(job):
+    path, tile, out_path = job
+    with Image.open(path) as img:
+        img.draft('RGB', (tile.rw, tile.rh))  # JPEG: decode at the smallest DCT scale still >= the tile
+        img.load()
+        img = img.convert('RGBA')
+    render_tile(img, tile).save(out_path, 'TIFF')  # uncompressed: cheap to write and re-read
+    return out_path
+
+def prenormalize(sources, s, staging_dir, workers, preview=False):
+    """Resize/crop every grid source to its tile in parallel processes; returns the staged tile paths."""
+    layout = layout_for(sources, s, preview)
+    jobs = [(sources[t.index], t, os.path.join(staging_dir, f"tile{t.index:06d}.tif")) for t in layout.tiles]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_normalize_tile, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+def merge_to_file(sources, s, output_path, preview=False, timeout=600):
+    """Write the merge to `output_path`; True when it came from OUTPUT_CACHE."""
+    if s.get('cache_outputs') and not preview:
+        key = OUTPUT_CACHE.key(sources, s, output_path)
+        if OUTPUT_CACHE.fetch(key, output_path):
+            return True
+        render_to_file(sources, s, output_path, preview, timeout)
+        OUTPUT_CACHE.store(key, output_path)
+        return False
+    render_to_file(sources, s, output_path, preview, timeout)
+    return False
+
+def render_to_file(sources, s, output_path, preview=False, timeout=600):
+    if s.get('animate', "off") != "off" and not preview:
+        merge_animated(sources, s, output_path)
+        return
+    loader = PIXEL_CACHE.get if s.get('pixel_cache') else load_source
+    if s.get('engine') == "pillow":
+        img = compose(sources, s, preview, loader=loader)
+        with TRACER.span('encode', format=os.path.splitext(output_path)[1]):
+            save_image(img, output_path, s, preview)
+        return
+    if s.get('engine') == "stream" and not preview:
+        merge_streaming(sources, s, output_path, timeout)
+        return
+    if s.get('prenormalize_workers') and s['mode'] == "grid" and s['grid_fit'] in ["crop", "scale"]:
+        with tempfile.TemporaryDirectory(prefix="imagemerger-tiles-") as staging:
+            with TRACER.span('prenormalize', tiles=len(sources)):
+                tiles = prenormalize(sources, s, staging, s['prenormalize_workers'], preview)
+            # the staged tiles are temporary: caching their pixels would only evict real sources
+            render_to_file(tiles, dict(s, grid_fit="original", prenormalize_workers=0, pixel_cache=False),
+                           output_path, preview, timeout)
+        return
+    dims = get_dimensions(sources)
+    if s.get('pixel_cache') and not s['show_labels']:  # labels come from the source file names
+        with TRACER.span('stage', files=len(sources)):
+            sources = PIXEL_CACHE.stage_mpc(sources, timeout)
+    chunks = None if preview else plan_chunks(sources, s, dims, os.cpu_count() or 1)
+    if chunks:
+        merge_chunked(sources, s, output_path, chunks, dims, timeout)
+        return
+    with tempfile.TemporaryDirectory(prefix="imagemerger-") as tmp:
+        with TRACER.span('build'):
+            cmd = build_command(sources, s, output_path, preview, dims, filelist_for(sources, tmp))
+        if not cmd:
+            raise ValueError("Failed to build command")
+        if s.get('memory_budget'):
+            cmd = with_limits(cmd, memory_limits(s['memory_budget']))
+        result = run_magick(cmd, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"ImageMagick error: {result.stderr.strip() or 'unknown error'}")
+
+def run_magick(cmd, timeout=600):
+    si = subprocess.STARTUPINFO() if os.name == 'nt' else None
+    if si:
+        si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    grant, env = GOVERNOR.current(), None
+    if grant:
+        # inserted ahead of any -limit already in cmd; ImageMagick keeps the last one given
+        cmd = with_limits(cmd, grant.limits)
+        env = dict(os.environ, **grant.env)
+    if TRACER.monitor_magick:
+        return run_magick_monitored(cmd, timeout, si, env)
+    with TRACER.span('magick', program=cmd[1] if cmd[1:2] == ['montage'] else cmd[0]):
+        return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout, startupinfo=si, shell=False,
+                              env=env)
+
+def run_magick_monitored(cmd, timeout, si, env=None):
+    """Run magick with -monitor (and -bench), turning its progress lines into 'magick:<stage>' spans."""
+    op = TRACER.current()
+    at = 2 if cmd[1:2] == ['montage'] else 1
+    extra = ['-monitor'] + (['-bench', str(TRACER.magick_bench)] if TRACER.magick_bench and at == 1 else [])
+    cmd = cmd[:at] + extra + cmd[at:]
+    with TRACER.span('spawn', op=op):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                startupinfo=si, shell=False, env=env)
+    start = time.perf_counter()
+    stages, other, seen = OrderedDict(), [], [start]
+
+    def read_stderr():
+        line = []
+        for ch in iter(lambda: proc.stderr.read(1), ''):
+            if ch not in '\r\n':
+                line.append(ch)
+                continue
+            text, line[:] = ''.join(line), []
+            match = MONITOR_LINE.match(text)
+            if match:
+                now = time.perf_counter()
+                stage = stages.setdefault(match['stage'].strip(), [seen[0], now, set()])
+                stage[1] = seen[0] = now
+                stage[2].add(match['target'])
+            elif text:
+                other.append(text)
+
+    output = []
+    readers = [threading.Thread(target=read_stderr, daemon=True),
+               threading.Thread(target=lambda: output.append(proc.stdout.read()), daemon=True)]
+    for reader in readers:
+        reader.start()
+    try:
+        proc.wait(timeout=timeout)  # the pipes are drained by the readers, so this can time out
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        raise
+    finally:
+        for reader in readers:
+            reader.join(timeout=5)
+    out = output[0] if output else ''
+    TRACER.record('magick', start, time.perf_counter() - start, op, program=cmd[at - 1])
+    for name, (first, last, targets) in stages.items():
+        TRACER.record(f"magick:{name}", first, last - first, op, images=len(targets))
+    for text in other:
+        if PERFORMANCE_LINE.search(text):
+            TRACER.record('magick:bench', start, 0.0, op, report=text.strip())
+    stderr = "\n".join(t for t in other if not PERFORMANCE_LINE.search(t))
+    return subprocess.CompletedProcess(cmd, proc.returncode, out, stderr)
+
+def output_filename(sources, mode, fmt):
+    base = os.path.splitext(os.path.basename(sources[0]))[0][:60]
+    count = len(sources)
+    suffix = f"_plus{count-1}" if count > 1 else ""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return f"{base}{suffix}_{timestamp}_{mode}.{fmt}"
+
+def copy_timestamp(source, output_path):
+    """Give the merged file the modification (and on Windows, creation) time of its first source."""
+    try:
+        ts = os.stat(source).st_mtime
+        os.utime(output_path, (ts, ts))
+        if os.name == 'nt':
+            set_windows_creation_time(output_path, ts)
+    except:
+        pass
+
+def set_windows_creation_time(path, ts):
+    try:
+        import ctypes
+        from ctypes import wintypes
+        k = ctypes.WinDLL('kernel32', use_last_error=True)
+        class FT(ctypes.Structure):
+            _fields_ = [("dwLowDateTime", wintypes.DWORD), ("dwHighDateTime", wintypes.DWORD)]
+        ns = int(ts * 10000000) + 116444736000000000
+        ft = FT(dwLowDateTime=ns & 0xFFFFFFFF, dwHighDateTime=ns >> 32)
+        h = k.CreateFileW(path, 0x100, 0, None, 3, 0, None)
+        if h != -1:
+            k.SetFileTime(h, ctypes.byref(ft), None, None)
+            k.CloseHandle(h)
+    except:
+        pass
+
+
 class ImageMagickMerger:
     def __init__(self, root):
         self.root = root
@@ -22,19 +2291,20 @@ class ImageMagickMerger:
         
         self.image_paths = []
         self.preview_timer = None
-        self.preview_thread = None
+        self.preview_scheduler = PreviewScheduler()
         self.preview_task_id = 0
+        self.preview_model = IncrementalCompositor(PROXY_CACHE.get)
+        META_CACHE.attach(os.path.join(CACHE_DIR, 'metadata.sqlite'))
+        self.trace = TRACER.add_sink(RingBufferSink())
+        # Header probes report back from worker threads; the Tk side drains them every 100 ms
+        self.probe_results = deque()
+        self.probe_generation = 0
+        self.probing = 0
+        self.unreadable = {}
+        self.preview_zoom = 1
         
-        self.vars = {
-            'mode': tk.StringVar(value="horizontal"), 'format': tk.StringVar(value="jpg"),
-            'quality': tk.IntVar(value=94), 'spacing': tk.IntVar(value=0),
-            'grid_cols': tk.IntVar(value=0), 'grid_fit': tk.StringVar(value="crop"),
-            'use_smallest': tk.BooleanVar(value=False), 'canvas_w': tk.IntVar(value=0),
-            'canvas_h': tk.IntVar(value=0), 'border': tk.IntVar(value=0),
-            'best_fit': tk.BooleanVar(value=False), 'show_labels': tk.BooleanVar(value=False),
-            'normalize_size': tk.BooleanVar(value=False), 'target_size': tk.IntVar(value=800),
-            'match_size': tk.BooleanVar(value=False), 'match_smallest': tk.BooleanVar(value=True)
-        }
+        var_types = {bool: tk.BooleanVar, int: tk.IntVar, str: tk.StringVar}
+        self.vars = {k: var_types[type(v)](value=v) for k, v in DEFAULT_SETTINGS.items()}
         self.setup_ui()
 
     def setup_ui(self):
@@ -56,6 +2326,7 @@ class ImageMagickMerger:
         self.status_label = tk.Label(status_frame, text="Waiting for images...", 
                                      font=('Arial Nova', 10), bg="#f5f5f5", fg="#555555")
         self.status_label.pack(side=tk.LEFT)
+        self.status_label.bind('<Button-1>', lambda e: self.show_unreadable() or self.show_timings('merge'))
         ttk.Button(status_frame, text="Browse", command=self.browse_files).pack(side=tk.RIGHT)
 
         # Options
@@ -121,6 +2392,17 @@ class ImageMagickMerger:
         for event in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
             quality_scale.bind(event, lambda e: self.wheel_scale(e, 'quality', 50, 100))
 
+        self.add_radio(opts, "Engine:", 'engine',
+                       [("ImageMagick", "magick"), ("Built-in", "pillow"), ("Streaming", "stream")])
+        ttk.Checkbutton(opts, text="Reuse identical earlier merges", variable=self.vars['cache_outputs'],
+                        command=self.on_change).pack(fill='x', pady=2)
+        ttk.Checkbutton(opts, text="Keep decoded sources on disk for re-merges", variable=self.vars['pixel_cache'],
+                        command=self.on_change).pack(fill='x', pady=2)
+        self.add_radio(opts, "Animation:", 'animate',
+                       [("Off", "off"), ("Loop", "loop"), ("Hold", "hold"), ("Stretch", "stretch")])
+        self.add_entry(opts, "Frame delay ms (0=keep):", 'frame_delay', 5)
+        self.add_entry(opts, "Also save as:", 'variants', 24)
+
         # Buttons
         btn_frame = ttk.Frame(left)
         btn_frame.pack(pady=10)
@@ -134,9 +2416,15 @@ class ImageMagickMerger:
         preview_frame.pack(expand=True, fill='both')
         self.preview_canvas = tk.Canvas(preview_frame, bg='#2a2a2a', highlightthickness=0)
         self.preview_canvas.pack(expand=True, fill='both')
+        # Ctrl+wheel zooms (re-rendering sharper tiles), dragging pans a zoomed preview
+        for event, step in (('<Control-MouseWheel>', None), ('<Control-Button-4>', 2), ('<Control-Button-5>', 0.5)):
+            self.preview_canvas.bind(event, lambda e, f=step: self.zoom_preview(f or (2 if e.delta > 0 else 0.5)))
+        self.preview_canvas.bind('<ButtonPress-1>', lambda e: self.preview_canvas.scan_mark(e.x, e.y))
+        self.preview_canvas.bind('<B1-Motion>', lambda e: self.preview_canvas.scan_dragto(e.x, e.y, gain=1))
         self.preview_status = tk.Label(preview_frame, text="Add images to see preview", 
                                        font=('Arial Nova', 10), bg="#f5f5f5", fg="#888888")
         self.preview_status.pack(pady=5)
+        self.preview_status.bind('<Button-1>', lambda e: self.show_timings('preview'))
         self.toggle_mode_options()
 
     def add_radio(self, parent, label, var_name, options):
@@ -182,21 +2470,25 @@ class ImageMagickMerger:
         elif mode in ["horizontal", "vertical"]:
             self.hvmode_frame.pack(fill='x', pady=5)
 
-    def on_change(self):
+    def on_change(self, delay=300):
         self.toggle_mode_options()
         if self.preview_timer:
             self.root.after_cancel(self.preview_timer)
         if len(self.image_paths) >= 2:
             self.preview_status.config(text="Preview updating...")
-            self.preview_timer = self.root.after(300, self.generate_preview)
+            self.preview_timer = self.root.after(delay, self.generate_preview)
+
+    def zoom_preview(self, factor):
+        zoom = int(max(1, min(4, self.preview_zoom * factor)))
+        if zoom != self.preview_zoom:
+            self.preview_zoom = zoom
+            self.on_change(delay=0)
 
     def browse_files(self):
         paths = filedialog.askopenfilenames(title="Select Images", 
                 filetypes=(("Images", "*.jpg *.jpeg *.png *.gif *.webp *.bmp *.tiff"), ("All", "*.*")))
         if paths:
-            self.image_paths.extend(paths)
-            self.update_status()
-            self.on_change()
+            self.add_images(paths)
 
     def handle_drop(self, event):
         data = event.data
@@ -213,227 +2505,187 @@ class ImageMagickMerger:
             except ValueError:
                 paths = data.split() # Fallback
         
-        # Clean and validate paths
-        valid_paths = []
-        for path in paths:
-            path = path.strip().strip('"').strip("'")
-            if path and os.path.isfile(path):
-                valid_paths.append(path)
-        
-        if valid_paths:
-            self.image_paths.extend(valid_paths)
-            self.update_status()
-            self.on_change()
+        # No stat here: the header probes flag missing or unreadable files off the Tk thread
+        paths = [p for p in (path.strip().strip('"').strip("'") for path in paths) if p]
+        if paths:
+            self.add_images(paths)
         else:
             messagebox.showwarning("Warning", "No valid image files found in drop")
 
+    def add_images(self, paths):
+        self.image_paths.extend(paths)
+        if not self.probing:
+            self.root.after(100, self.drain_probes)
+        self.probing += len(paths)
+        generation = self.probe_generation
+        META_CACHE.warm(paths, lambda i, path, info: self.probe_results.append((generation, path, info)))
+        self.update_status()
+        self.on_change(delay=0)
+
+    def drain_probes(self):
+        dropped = set()
+        while self.probe_results:
+            generation, path, info = self.probe_results.popleft()
+            if generation != self.probe_generation:
+                continue
+            self.probing -= 1
+            if info.error:
+                self.unreadable[path] = info.error
+                dropped.add(path)
+        if dropped:
+            self.image_paths = [p for p in self.image_paths if p not in dropped]
+        self.update_status()
+        if self.probing > 0:
+            self.root.after(100, self.drain_probes)
+        if dropped:
+            self.on_change()
+
+    def show_unreadable(self):
+        if self.unreadable:
+            lines = [f"{os.path.basename(p)}: {e}" for p, e in list(self.unreadable.items())[:20]]
+            more = len(self.unreadable) - len(lines)
+            messagebox.showwarning("Unreadable files", "\n".join(lines) + (f"\n… and {more} more" if more > 0 else ""))
+            return True
+
+    def show_timings(self, operation):
+        """Every stage of the latest preview or merge, threaded and magick-internal ones included."""
+        spans = self.trace.last(operation)
+        if not spans:
+            return
+        totals = OrderedDict()
+        for span in spans[:-1]:
+            count, seconds = totals.get(span.name, (0, 0.0))
+            totals[span.name] = (count + 1, seconds + span.seconds)
+        lines = [f"{name}: {seconds * 1000:.0f} ms" + (f" ({count}×)" if count > 1 else "")
+                 for name, (count, seconds) in totals.items()]
+        lines += [span.attrs['report'] for span in spans if 'report' in span.attrs]
+        lines.append(f"\ntotal: {spans[-1].seconds * 1000:.0f} ms")
+        messagebox.showinfo(f"Last {operation} timings", "\n".join(lines))
+
     def update_status(self):
         count = len(self.image_paths)
-        self.status_label.config(text=f"{count} images loaded")
+        text = f"{count} images loaded"
+        if self.probing > 0:
+            text += f" · reading {self.probing} headers"
+        if self.unreadable:
+            text += f" · {len(self.unreadable)} unreadable skipped"
+        self.status_label.config(text=text)
         self.merge_btn['state'] = tk.NORMAL if count >= 2 else tk.DISABLED
 
     def clear_images(self):
         self.image_paths = []
+        self.probe_generation += 1
+        self.probing = 0
+        self.unreadable = {}
+        self.preview_zoom = 1
         self.status_label.config(text="Waiting for images...")
         self.merge_btn['state'] = tk.DISABLED
         self.preview_canvas.delete('all')
         self.preview_status.config(text="Add images to see preview")
         if self.preview_timer:
             self.root.after_cancel(self.preview_timer)
+        self.preview_scheduler.cancel()
+        PROXY_CACHE.clear()
+        self.preview_model.reset()
+
+    def settings(self):
+        return {k: var.get() for k, var in self.vars.items()}
 
     def get_dimensions(self):
-        dims = []
-        for path in self.image_paths:
-            try:
-                with Image.open(path) as img:
-                    dims.append(img.size)
-            except:
-                dims.append((0, 0))
-        return dims
+        return get_dimensions(self.image_paths)
 
     def build_command(self, output_path, preview=False):
-            # Optimization: Remove harmful escaping. shell=False handles paths correctly.
-            paths = [p.replace('\\', '/') for p in self.image_paths]
-            output_path = output_path.replace('\\', '/')
-            
-            mode = self.vars['mode'].get()
-            scale = 0.5 if preview else 1.0
-            v = self.vars  # Shorthand
-
-            if mode == "ashlar":
-                dims = self.get_dimensions()
-                if not dims:
-                    return None
-                
-                cw, ch = v['canvas_w'].get(), v['canvas_h'].get()
-                if cw == 0 or ch == 0:
-                    area = sum(w * h for w, h in dims)
-                    side = max(int(math.sqrt(area * 1.5)), 1000, int(max(w for w,h in dims) * 1.2))
-                    cw = ch = side
-                if scale < 1:
-                    cw, ch = int(cw * scale), int(ch * scale)
-                
-                cmd = ['magick', '-quiet']
-                cmd.extend(paths + ['-depth', '8'])
-                
-                if v['normalize_size'].get():
-                    cmd.extend(['-resize', f'{int(v["target_size"].get() * scale)}x{int(v["target_size"].get() * scale)}'])
-                if v['format'].get() in ['jpg', 'jpeg']:
-                    cmd.extend(['-sampling-factor', '4:4:4', '-quality', str(85 if scale < 1 else v['quality'].get())])
-                border = v['border'].get()
-                if border == 0:
-                    cmd.extend(['-bordercolor', 'transparent' if v['format'].get() == 'png' else 'white'])
-                if v['best_fit'].get():
-                    cmd.extend(['-define', 'ashlar:best-fit=true'])
-                if v['show_labels'].get():
-                    cmd.extend(['-label', '%f'])
-                cmd.append(f"ashlar:{output_path}[{cw}x{ch}+{border}+{border}]")
-                return cmd
-
-            elif mode == "grid":
-                cols = v['grid_cols'].get() or int(math.ceil(math.sqrt(len(paths))))
-                
-                cmd = ['magick', 'montage', '-quiet']
-                cmd.extend(paths + ['-depth', '8'])
-                
-                if v['grid_fit'].get() in ["crop", "scale"]:
-                    dims = [d for d in self.get_dimensions() if d[0] > 0 and d[1] > 0]
-                    if dims:
-                        if v['use_smallest'].get():
-                            tw, th = min(dims, key=lambda d: d[0] * d[1])
-                        else:
-                            tw = sum(w for w,h in dims) // len(dims)
-                            th = sum(h for w,h in dims) // len(dims)
-                        if scale < 1:
-                            tw, th = int(tw * scale), int(th * scale)
-                        fit_bg = 'white' if v['format'].get() in ['jpg', 'jpeg'] else 'transparent'
-                        if v['grid_fit'].get() == "crop":
-                            # cover: fill the box, crop whatever overflows
-                            cmd.extend(['-resize', f'{tw}x{th}^', '-gravity', 'center', '-extent', f'{tw}x{th}'])
-                        else:
-                            # scale (contain): fit inside the box, pad the shortfall
-                            cmd.extend(['-resize', f'{tw}x{th}', '-gravity', 'center',
-                                        '-background', fit_bg, '-extent', f'{tw}x{th}'])
-                
-                bg = 'white' if v['format'].get() in ['jpg', 'jpeg'] else 'transparent'
-                sp = v['spacing'].get()
-                cmd.extend(['-background', bg, '-tile', f'{cols}x', '-geometry', f'+{sp}+{sp}'])
-                if v['format'].get() in ['jpg', 'jpeg']:
-                    cmd.extend(['-sampling-factor', '4:4:4', '-quality', str(85 if scale < 1 else v['quality'].get()), 
-                            '-alpha', 'remove', '-alpha', 'off'])
-                cmd.append(output_path)
-                return cmd
-
-            else:  # horizontal/vertical
-                cmd = ['magick', '-quiet']
-                cmd.extend(paths)
-                
-                if scale < 1:
-                    cmd.extend(['-resize', '800x800>'])
-                
-                if v['match_size'].get():
-                    dims = self.get_dimensions()
-                    if dims:
-                        func = min if v['match_smallest'].get() else max
-                        if mode == "vertical":
-                            w = func(w for w,h in dims if w > 0)
-                            if w > 0:
-                                target = int(w * scale) if scale < 1 else w
-                                cmd.extend(['-resize', f'{min(target, 800)}x' if scale < 1 else f'{w}x'])
-                        else:
-                            h = func(h for w,h in dims if h > 0)
-                            if h > 0:
-                                target = int(h * scale) if scale < 1 else h
-                                cmd.extend(['-resize', f'x{min(target, 800)}' if scale < 1 else f'x{h}'])
-                
-                if v['spacing'].get() > 0:
-                    cmd.extend(['-bordercolor', 'transparent', '-border', 
-                            f'{v["spacing"].get()}x{v["spacing"].get()}'])
-                cmd.append('+append' if mode == "horizontal" else '-append')
-                if v['format'].get() in ['jpg', 'jpeg']:
-                    cmd.extend(['-sampling-factor', '4:4:4', '-quality', str(85 if scale < 1 else v['quality'].get())])
-                cmd.append(output_path)
-                return cmd
+        return build_command(self.image_paths, self.settings(), output_path, preview)
 
     def generate_preview(self):
         if len(self.image_paths) < 2:
             return
         
-        self.preview_status.config(text="Generating...")
         self.preview_task_id += 1
         current_id = self.preview_task_id
         
-        fd, temp_path = tempfile.mkstemp(suffix='.jpg')
-        os.close(fd)
-        
-        cmd = self.build_command(temp_path.replace('\\', '/'), preview=True)
-        if not cmd:
-            self.preview_status.config(text="Command build failed")
-            return
-
-        self.preview_thread = threading.Thread(
-            target=self._preview_worker, 
-            args=(cmd, temp_path, current_id), 
-            daemon=True
-        )
-        self.preview_thread.start()
+        # Snapshot the Tk state here; the worker thread must not touch Tk variables
+        s = self.settings()
+        fit = (max(self.preview_canvas.winfo_width() - 20, 100) * self.preview_zoom,
+               max(self.preview_canvas.winfo_height() - 20, 100) * self.preview_zoom)
+        scheduler = self.preview_scheduler
+        scheduler.submit(self._preview_worker, list(self.image_paths), s, current_id, fit)
+        text = "Generating..."
+        if scheduler.queue_depth > 1:
+            text += f" (previous render cancelled; {scheduler.coalesced} skipped unstarted so far)"
+        if scheduler.last_render_time is not None:
+            text += f" · last render {scheduler.last_render_time * 1000:.0f} ms"
+        self.preview_status.config(text=text)
 
-    def _preview_worker(self, cmd, temp_path, task_id):
+    def _preview_worker(self, task, sources, s, task_id, fit):
         try:
-            if self.preview_task_id != task_id: return
-
-            si = subprocess.STARTUPINFO() if os.name == 'nt' else None
-            if si:
-                si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60, startupinfo=si, shell=False)
-            
-            if self.preview_task_id != task_id:
-                return
+            # Re-composite cached preview proxies in-process; nothing full-size is decoded
+            with TRACER.operation('preview') as op:
+                infos = META_CACHE.peek_many(sources)
+                if any(info is None for info in infos) and s['mode'] == "ashlar":
+                    # packing stand-in sizes would cost as much as the real packing and look nothing like it
+                    self.root.after(0, lambda: self.preview_status.config(text="Reading headers…"))
+                elif any(info is None for info in infos):
+                    # headers still being read (add_images warms them): show the layout with
+                    # stand-in sizes right away, then wait for the probes already under way
+                    with TRACER.span('sketch'):
+                        sketch = sketch_layout(sources, layout_for(sources, s, preview=True, fit=fit,
+                                                                   dims=provisional_dims(infos)))
+                    task.check()
+                    self.root.after(0, lambda: self.show_preview(sketch, task_id, " · reading headers…"))
+                with TRACER.span('layout'):
+                    layout = layout_for(sources, s, preview=True, fit=fit)
+                task.check()
 
-            if result.returncode != 0:
-                error_msg = result.stderr[:100] if result.stderr else "Unknown error"
-                self.root.after(0, lambda: self.preview_status.config(text=f"Error: {error_msg}"))
-                return
-            
-            self.root.after(0, lambda: self.display_preview(temp_path, task_id))
-            
-        except subprocess.TimeoutExpired:
-            self.root.after(0, lambda: self.preview_status.config(text="Preview timeout (60s)"))
+                def progress(partial):
+                    # placeholders first, then tiles as they decode; each frame replaces the last
+                    task.check()
+                    self.root.after(0, lambda: self.show_preview(partial, task_id, " · loading…"))
+                img = self.preview_model.render(sources, layout, check=task.check,
+                                                placeholder=preview_placeholder, progress=progress)
+                if s['format'] in ['jpg', 'jpeg']:
+                    img = img.convert('RGB')
+            note = ""
+            if s['mode'] == "ashlar":
+                dropped = len(sources) - len(layout.tiles)
+                note = f", {packing_efficiency(layout):.0%} packed" + (f", {dropped} dropped" if dropped else "")
+            task.check()
+            self.root.after(0, lambda: self.show_preview(img, task_id, note, op))
+        except Cancelled:
+            raise
         except Exception as e:
-            self.root.after(0, lambda: self.preview_status.config(text=f"Error: {str(e)[:50]}"))
-        finally:
-            if self.preview_task_id != task_id or ('result' in locals() and result.returncode != 0):
-                if os.path.exists(temp_path):
-                    try: os.unlink(temp_path)
-                    except Exception: pass
-                
-    def display_preview(self, path, task_id):
+            self.root.after(0, lambda: self.preview_status.config(text=f"Error: {str(e)[:100]}"))
+
+    def show_preview(self, img, task_id, note="", op=None):
         if self.preview_task_id != task_id:
-            if os.path.exists(path):
-                try: os.unlink(path)
-                except: pass
             return
-
         try:
-            with Image.open(path) as img:
-                img.load()
-                w, h = self.preview_canvas.winfo_width(), self.preview_canvas.winfo_height()
-                if w <= 1 or h <= 1:
-                    self.root.after(100, lambda: self.display_preview(path, task_id))
-                    return
-                
-                img.thumbnail((w - 20, h - 20), Image.Resampling.LANCZOS)
+            w, h = self.preview_canvas.winfo_width(), self.preview_canvas.winfo_height()
+            if w <= 1 or h <= 1:
+                self.root.after(100, lambda: self.show_preview(img, task_id, note, op))
+                return
+            
+            if self.preview_zoom == 1:
+                with TRACER.span('thumbnail', op=op):
+                    img.thumbnail((w - 20, h - 20), Image.Resampling.LANCZOS)
+            with TRACER.span('display', op=op):
                 self.preview_image = ImageTk.PhotoImage(img)
                 self.preview_canvas.delete('all')
-                self.preview_canvas.create_image(w // 2, h // 2, image=self.preview_image, anchor='center')
-                self.preview_status.config(text=f"{img.width}×{img.height} (scaled)")
+                if self.preview_zoom == 1:
+                    self.preview_canvas.config(scrollregion=(0, 0, w, h))
+                    self.preview_canvas.xview_moveto(0)
+                    self.preview_canvas.yview_moveto(0)
+                    self.preview_canvas.create_image(w // 2, h // 2, image=self.preview_image, anchor='center')
+                else:
+                    # keep the view where the user panned it; centre the image while it is smaller
+                    x, y = max(0, (w - img.width) // 2), max(0, (h - img.height) // 2)
+                    self.preview_canvas.config(scrollregion=(0, 0, max(w, img.width), max(h, img.height)))
+                    self.preview_canvas.create_image(x, y, image=self.preview_image, anchor='nw')
+            timing = f" · {op.summary()}" if op else ""
+            zoom = f" at {self.preview_zoom}×" if self.preview_zoom > 1 else " (scaled)"
+            self.preview_status.config(text=f"{img.width}×{img.height}{zoom}{note}{timing}")
         except Exception as e:
             self.preview_status.config(text=f"Display error: {str(e)[:50]}")
-        finally:
-            if os.path.exists(path):
-                try: os.unlink(path)
-                except Exception: pass
 
     def merge_images(self):
         if len(self.image_paths) < 2:
@@ -442,38 +2694,22 @@ class ImageMagickMerger:
 
         try:
             source_dir = os.path.dirname(self.image_paths[0]) or os.getcwd()
-            
-            base = os.path.splitext(os.path.basename(self.image_paths[0]))[0][:60]
-            count = len(self.image_paths)
-            suffix = f"_plus{count-1}" if count > 1 else ""
-            mode = self.vars['mode'].get()
-            fmt = self.vars['format'].get()
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{base}{suffix}_{timestamp}_{mode}.{fmt}"
-            
+            filename = output_filename(self.image_paths, self.vars['mode'].get(), self.vars['format'].get())
             output_path = os.path.join(source_dir, filename)
             
-            cmd = self.build_command(output_path.replace('\\', '/'))
-            if not cmd:
-                raise Exception("Failed to build command")
-            
-            si = subprocess.STARTUPINFO() if os.name == 'nt' else None
-            if si:
-                si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=600, startupinfo=si, shell=False)
-            if result.returncode != 0:
-                raise Exception(f"ImageMagick error: {result.stderr}")
-            
-            try:
-                ts = os.stat(self.image_paths[0]).st_mtime
-                os.utime(output_path, (ts, ts))
-                if os.name == 'nt':
-                    self.set_windows_creation_time(output_path, ts)
-            except:
-                pass
+            s = self.settings()
+            variants = []
+            with TRACER.operation('merge') as op, GOVERNOR.admit(estimate_memory(self.image_paths, s)):
+                if s['variants'].strip():
+                    variants = merge_variants(self.image_paths, s, output_path.replace('\\', '/'))
+                else:
+                    merge_to_file(self.image_paths, s, output_path.replace('\\', '/'))
+            for written in [v['output'] for v in variants] or [output_path]:
+                copy_timestamp(self.image_paths[0], written)
+            self.status_label.config(text=op.summary())
+            extra = "".join(f"\n{os.path.basename(v['output'])}: {format_variant(v)}" for v in variants)
             
-            if messagebox.askyesno("Done", "Open the merged image?"):
+            if messagebox.askyesno("Done", f"Merged ({op.summary()}).{extra}\n\nOpen the merged image?"):
                 opener = 'startfile' if os.name == 'nt' else 'open' if 'darwin' in os.uname().sysname.lower() else 'xdg-open'
                 if opener == 'startfile':
                     os.startfile(output_path)
@@ -484,23 +2720,694 @@ class ImageMagickMerger:
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
-    def set_windows_creation_time(self, path, ts):
+# --- Benchmarks ------------------------------------------------------------------
+
+CORPUS_FORMATS = ['jpg', 'png', 'webp', 'gif']
+BENCH_CASES = {
+    'horizontal': {'mode': "horizontal"},
+    'vertical': {'mode': "vertical"},
+    'grid-crop': {'mode': "grid", 'grid_fit': "crop"},
+    'grid-scale': {'mode': "grid", 'grid_fit': "scale"},
+    'grid-original': {'mode': "grid", 'grid_fit': "original"},
+    'ashlar': {'mode': "ashlar"},
+    'preview': {'mode': "grid"},  # cold then warm in-process preview, independent of engine
+}
+
+def make_synthetic_images(directory, count, size=(800, 600), seed=0):
+    """Write (or reuse) a deterministic corpus of `count` mixed-format images; returns their paths."""
+    spec = {'count': count, 'size': list(size), 'seed': seed, 'version': 2}
+    index = os.path.join(directory, 'corpus.json')
+    try:
+        with open(index, encoding='utf-8') as f:
+            existing = json.load(f)
+        if existing['spec'] == spec and all(os.path.isfile(p) for p in existing['paths']):
+            return existing['paths']
+    except (OSError, ValueError, KeyError):
+        pass
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        aspect = 2 ** rng.uniform(-1, 1)
+        area = size[0] * size[1] * rng.uniform(0.5, 1.5)
+        w, h = max(16, int(math.sqrt(area * aspect))), max(16, int(math.sqrt(area / aspect)))
+        img = Image.frombytes('RGB', (8, 6), rng.randbytes(8 * 6 * 3)).resize((w, h), Image.Resampling.BICUBIC)
+        fmt = CORPUS_FORMATS[i % len(CORPUS_FORMATS)]
+        path = os.path.join(directory, f"img{i:05d}.{fmt}")
+        if fmt == 'png' and i % 3 == 0:
+            img.putalpha(Image.linear_gradient('L').resize((w, h)))
+        if fmt == 'gif':
+            img = img.convert('P', palette=Image.Palette.ADAPTIVE)
+        img.save(path, **({'quality': 90} if fmt in ['jpg', 'webp'] else {}))
+        paths.append(path)
+    with open(index, 'w', encoding='utf-8') as f:
+        json.dump({'spec': spec, 'paths': paths}, f)
+    return paths
+
+def run_bench_case(case, engine, sources, out_dir):
+    """Run one benchmark case in this process; returns {'seconds', 'output_bytes', ...}."""
+    s = dict(DEFAULT_SETTINGS, engine=engine, **BENCH_CASES[case])
+    META_CACHE.get_many(sources)  # header probing is its own stage; keep it out of the merge timing
+    if case == 'preview':
+        model = IncrementalCompositor(PROXY_CACHE.get)
+        times = []
+        for _ in range(2):
+            start = time.perf_counter()
+            img = model.render(sources, layout_for(sources, s, preview=True, fit=(800, 600)))
+            times.append(time.perf_counter() - start)
+            model.reset()  # the warm run re-composites cached proxies, as a settings change would
+        return {'seconds': times[0], 'warm_seconds': times[1], 'output_bytes': len(img.tobytes())}
+    output = os.path.join(out_dir, f"{case}_{engine}.jpg")
+    start = time.perf_counter()
+    merge_to_file(sources, s, output)
+    return {'seconds': time.perf_counter() - start, 'output_bytes': os.path.getsize(output)}
+
+def _measure_case(case, engine, corpus_dir, corpus_count, count, size, seed, out_dir):
+    """Run a case in a fresh interpreter, so caches start cold and peak RSS is its own."""
+    spec = json.dumps({'case': case, 'engine': engine, 'corpus': corpus_dir, 'corpus_count': corpus_count,
+                       'count': count, 'size': list(size), 'seed': seed, 'out': out_dir})
+    return _measure_child(['--run-case', spec])
+
+def peak_rss_mb():
+    """High-water RSS in MiB of this process, or of its largest finished child if that was bigger."""
+    peak = None
+    try:  # VmHWM belongs to this address space; ru_maxrss starts from the parent's peak at fork
+        with open('/proc/self/status') as f:
+            peak = next(int(line.split()[1]) / 1024 for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        pass
+    if resource:
+        unit = 2**20 if sys.platform == 'darwin' else 2**10  # ru_maxrss is KiB on Linux, bytes on macOS
+        if peak is None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+    return peak
+
+def _measure_child(bench_args):
+    """Run `ImageMerger.py bench <bench_args>` and return its last output line as JSON (with its peak_rss_mb)."""
+    with tempfile.TemporaryFile('w+') as out:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), 'bench'] + bench_args,
+                              stdout=out, stderr=subprocess.STDOUT, text=True)
+        out.seek(0)
+        lines = out.read().strip().splitlines()
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        result = {'error': (lines[-1] if lines else f"exit code {proc.returncode}")}
+    result.setdefault('peak_rss_mb', None)
+    return result
+
+def benchmark_suite(counts, cases, engines, size=(800, 600), seed=0, repeat=1, corpus_dir=None, progress=print):
+    """Time every (case, count, engine) on a synthetic corpus; returns a JSON-ready report."""
+    report = {'created': datetime.now().isoformat(timespec='seconds'), 'platform': sys.platform,
+              'python': sys.version.split()[0], 'pillow': Image.__version__, 'cpus': os.cpu_count(),
+              'size': list(size), 'seed': seed, 'results': []}
+    with tempfile.TemporaryDirectory(prefix="imagemerger-bench-") as tmp:
+        corpus_dir = corpus_dir or os.path.join(tmp, 'corpus')
+        make_synthetic_images(corpus_dir, max(counts), size, seed)
+        for case in cases:
+            for count in counts:
+                for engine in (['-'] if case == 'preview' else engines):
+                    runs = [_measure_case(case, engine, corpus_dir, max(counts), count, size, seed, tmp)
+                            for _ in range(repeat)]
+                    ok = [r for r in runs if 'error' not in r]
+                    row = min(ok, key=lambda r: r['seconds']) if ok else runs[-1]
+                    row = dict(row, case=case, engine=engine, count=count)
+                    row.setdefault('error', None)
+                    report['results'].append(row)
+                    if progress:
+                        progress(format_bench_row(row))
+    return report
+
+def format_bench_row(row):
+    if row['error']:
+        return f"{row['case']:14} {row['count']:6} {row['engine']:7}  error: {row['error'][:80]}"
+    rss = f"{row['peak_rss_mb']:8.1f} MB" if row.get('peak_rss_mb') is not None else "       - MB"
+    warm = f"  (warm {row['warm_seconds']:.3f}s)" if 'warm_seconds' in row else ""
+    return (f"{row['case']:14} {row['count']:6} {row['engine']:7} {row['seconds']:9.3f}s {rss} "
+            f"{row['output_bytes'] / 2**20:9.2f} MB out{warm}")
+
+def compare_benchmarks(baseline, current, threshold=0.15, progress=print):
+    """Flag cases whose time or peak RSS grew by more than `threshold` (0.15 = 15%); returns them."""
+    def keyed(report):
+        return {(r['case'], r['engine'], r['count']): r for r in report['results']}
+    old, regressions = keyed(baseline), []
+    for key, new in keyed(current).items():
+        before = old.get(key)
+        if before is None or before['error'] or new['error']:
+            continue
+        flagged = []
+        for metric in ('seconds', 'peak_rss_mb'):
+            a, b = before.get(metric), new.get(metric)
+            if a and b and b > a * (1 + threshold):
+                flagged.append({'case': key[0], 'engine': key[1], 'count': key[2], 'metric': metric,
+                                'before': a, 'after': b, 'change': b / a - 1})
+        regressions.extend(flagged)
+        if progress:
+            change = new['seconds'] / before['seconds'] - 1 if before['seconds'] else 0
+            progress(f"{key[0]:14} {key[2]:6} {key[1]:7} {before['seconds']:9.3f}s -> {new['seconds']:9.3f}s "
+                     f"({change:+.0%}){'  REGRESSION' if flagged else ''}")
+    return regressions
+
+def benchmark_packing(counts, seed=0, progress=print):
+    """Time the Ashlar packer on random rectangles and report how much of the canvas they cover."""
+    rng = random.Random(seed)
+    results = []
+    for count in counts:
+        sizes = [(rng.randint(200, 1600), rng.randint(200, 1600)) for _ in range(count)]
+        for best_fit in (False, True):
+            start = time.perf_counter()
+            placements, cw, ch = _pack_ashlar(sizes, 4, None, best_fit)  # uncached: time the packer itself
+            seconds = time.perf_counter() - start
+            covered = sum(w * h for (w, h), p in zip(sizes, placements) if p)
+            row = {'count': count, 'best_fit': best_fit, 'seconds': seconds, 'canvas': [cw, ch],
+                   'efficiency': covered / (cw * ch)}
+            results.append(row)
+            if progress:
+                progress(f"{count:6} best_fit={best_fit!s:5} {seconds:8.3f}s  {cw}x{ch}  {row['efficiency']:.1%} packed")
+    return results
+
+def benchmark_prenormalize(count, worker_counts, size=(800, 600), progress=print):
+    """Time the grid pre-normalization stage (and the montage after it) for each worker count."""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="imagemerger-bench-") as tmp:
+        sources = make_synthetic_images(tmp, count, size)
+        META_CACHE.get_many(sources)
+        s = dict(DEFAULT_SETTINGS, mode="grid")
+        baseline = None
+        for workers in worker_counts:
+            with tempfile.TemporaryDirectory(dir=tmp) as staging:
+                start = time.perf_counter()
+                tiles = prenormalize(sources, s, staging, workers)
+                stage = time.perf_counter() - start
+                row = {'count': count, 'workers': workers, 'stage_seconds': stage, 'montage_seconds': None,
+                       'error': None}
+                try:
+                    start = time.perf_counter()
+                    render_to_file(tiles, dict(s, grid_fit="original"), os.path.join(tmp, "out.jpg"))
+                    row['montage_seconds'] = time.perf_counter() - start
+                except Exception as e:
+                    row['error'] = str(e)
+            baseline = baseline or stage
+            results.append(row)
+            if progress:
+                montage = f"{row['montage_seconds']:.3f}s" if row['error'] is None else f"error: {row['error']}"
+                progress(f"{count:6} images {workers:3} workers  stage {stage:8.3f}s ({baseline / stage:4.1f}x)"
+                         f"  montage {montage}")
+    return results
+
+def run_streaming_case(side, tile, budget, out_dir):
+    """Stream a grid of `tile`-sized sources about `side` pixels square to PNG in this process."""
+    cols = max(1, -(-side // tile))
+    sources = make_synthetic_images(os.path.join(out_dir, 'corpus'), 4, (tile, tile))
+    sources = [sources[i % len(sources)] for i in range(cols * cols)]
+    s = dict(DEFAULT_SETTINGS, mode="grid", grid_cols=cols, engine="stream", format="png", memory_budget=budget)
+    output = os.path.join(out_dir, "streamed.png")
+    infos = META_CACHE.get_many(sources)
+    layout = layout_for(sources, s, dims=[(i.width, i.height) for i in infos])
+    _, _, bound = streaming_memory(infos, layout, budget * 2**20)
+    baseline = peak_rss_mb() or 0
+    start = time.perf_counter()
+    merge_streaming(sources, s, output)
+    with Image.open(output) as img:
+        size = img.size
+    return {'seconds': time.perf_counter() - start, 'output_bytes': os.path.getsize(output), 'size': list(size),
+            'baseline_mb': baseline, 'bound_mb': bound / 2**20}
+
+def benchmark_streaming(side, tile=5000, budget=512, progress=print):
+    """Fail when a streamed `side`-pixel merge peaks above its RSS before merging plus streaming_memory's bound."""
+    with tempfile.TemporaryDirectory(prefix="imagemerger-bench-") as tmp:
+        make_synthetic_images(os.path.join(tmp, 'corpus'), 4, (tile, tile))  # here, so the child only merges
+        spec = json.dumps({'side': side, 'tile': tile, 'budget': budget, 'out': tmp})
+        row = _measure_child(['--run-streaming', spec])
+    row.update(side=side, tile=tile, budget_mb=budget)
+    if row.get('bound_mb') is not None:
+        row['limit_mb'] = row['baseline_mb'] + row['bound_mb']
+    row.setdefault('error', None)
+    if row['error'] is None and row['peak_rss_mb'] is not None and row['peak_rss_mb'] > row['limit_mb']:
+        row['error'] = f"peak RSS {row['peak_rss_mb']:.0f} MiB is over the {row['limit_mb']:.0f} MiB limit"
+    if progress:
+        if row.get('size'):
+            rss = f"{row['peak_rss_mb']:.0f}" if row['peak_rss_mb'] is not None else "-"
+            progress(f"{row['size'][0]}x{row['size'][1]} streamed in {row['seconds']:.1f}s, peak {rss} MiB "
+                     f"(limit {row['limit_mb']:.0f}), {row['output_bytes'] / 2**20:.1f} MB out")
+        if row['error']:
+            progress(f"FAIL {row['error']}")
+    return row
+
+# --- Headless batch mode -------------------------------------------------------
+
+def load_manifest(path):
+    """Read a batch manifest: a list of jobs, or {"defaults": {...}, "jobs": [...]}."""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {'jobs': data}
+    base_dir = os.path.dirname(os.path.abspath(path))
+    defaults = dict(DEFAULT_SETTINGS, **data.get('defaults', {}))
+    jobs = []
+    for i, entry in enumerate(data.get('jobs', [])):
+        unknown = set(entry) - set(DEFAULT_SETTINGS) - {'sources', 'output', 'name'}
+        if unknown:
+            raise ValueError(f"Job {i}: unknown keys {sorted(unknown)}")
+        sources = []
+        for pattern in entry.get('sources', []):
+            pattern = os.path.join(base_dir, os.path.expanduser(pattern))
+            sources.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+        settings = dict(defaults, **{k: v for k, v in entry.items() if k in DEFAULT_SETTINGS})
+        output = entry.get('output')
+        if output:
+            output = os.path.join(base_dir, os.path.expanduser(output))
+        jobs.append({'name': entry.get('name') or f"job{i + 1}", 'sources': sources,
+                     'settings': settings, 'output': output})
+    return jobs
+
+def run_job(job, timeout=600):
+    """Run one manifest job; returns a result dict instead of raising so a batch keeps going."""
+    start = time.perf_counter()
+    sources, s = job['sources'], job['settings']
+    result = {'name': job['name'], 'count': len(sources), 'output': None, 'ok': False, 'error': None,
+              'cached': False}
+    try:
+        if len(sources) < 2:
+            raise ValueError("Need at least 2 images")
+        missing = [p for p in sources if not os.path.isfile(p)]
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} missing source(s), first: {missing[0]}")
+        infos = META_CACHE.get_many(sources)
+        unreadable = [(p, info.error) for p, info in zip(sources, infos) if info.error]
+        if unreadable:
+            raise ValueError(f"{len(unreadable)} unreadable source(s), first: {unreadable[0][0]} ({unreadable[0][1]})")
+        output = job['output']
+        if not output or os.path.isdir(output):
+            out_dir = output or os.path.dirname(sources[0]) or os.getcwd()
+            output = os.path.join(out_dir, output_filename(sources, s['mode'], s['format']))
+        need = estimate_memory(sources, s, [(info.width, info.height) for info in infos])
+        variants = None
+        with TRACER.operation(job['name']) as op, GOVERNOR.admit(need):
+            if s.get('variants'):  # always composited afresh: the result cache holds single files
+                variants = merge_variants(sources, s, output)
+                cached = False
+            else:
+                cached = merge_to_file(sources, s, output, timeout=timeout)
+        for written in [v['output'] for v in variants or []] or [output]:
+            copy_timestamp(sources[0], written)
+        result.update(output=output, ok=True, cached=cached,
+                      stages={name: round(seconds, 4) for name, seconds in op.totals.items()})
+        if variants:
+            result['variants'] = variants
+    except subprocess.TimeoutExpired:
+        result['error'] = f"timeout ({timeout}s)"
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def run_batch(jobs, workers=0, timeout=600, progress=None):
+    """Run jobs on a bounded thread pool (each job is a magick child process) sized to the cores."""
+    workers = workers or os.cpu_count() or 1
+    GOVERNOR.jobs = min(workers, max(len(jobs), 1))
+    results = []
+    with ThreadPoolExecutor(max_workers=GOVERNOR.jobs) as pool:
+        futures = [pool.submit(run_job, job, timeout) for job in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            if progress:
+                progress(done, len(jobs), result)
+    return results
+
+def print_progress(done, total, result):
+    status = "FAIL" if not result['ok'] else "hit " if result['cached'] else "ok  "
+    detail = result['output'] if result['ok'] else result['error']
+    if result.get('stages') and not result['cached']:
+        detail += "  [" + " · ".join(f"{k} {v:.2f}s" for k, v in result['stages'].items() if ':' not in k) + "]"
+    print(f"[{done}/{total}] {status} {result['seconds']:7.2f}s  {result['name']} ({result['count']} images): {detail}",
+          flush=True)
+    for variant in result.get('variants', [])[1:]:
+        print(f"        {variant['output']}: {format_variant(variant)}", flush=True)
+
+# --- Watch folders -----------------------------------------------------------------
+
+class InotifyWatcher:
+    """New files in one directory via Linux inotify: reported once closed after writing or moved in."""
+    IN_CLOSE_WRITE, IN_MOVED_TO = 0x8, 0x80
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        self.directory = directory
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0 or libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                                 self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            if self.fd >= 0:
+                os.close(self.fd)
+            raise OSError(errno, f"inotify: {os.strerror(errno)}")
+
+    def poll(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data, paths, i = os.read(self.fd, 65536), [], 0
+        while i < len(data):
+            _, _, _, length = self.EVENT.unpack_from(data, i)
+            name = data[i + self.EVENT.size:i + self.EVENT.size + length].rstrip(b'\0')
+            i += self.EVENT.size + length
+            if name:
+                paths.append(os.path.join(self.directory, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Portable fallback: rescans the directory and reports a file once its size and mtime hold still."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.known = self._scan()
+        self.changing = {}
+
+    def _scan(self):
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return {}
+        return {e.path: (e.stat().st_size, e.stat().st_mtime_ns) for e in entries if e.is_file()}
+
+    def poll(self, timeout):
+        time.sleep(timeout)
+        ready = []
+        for path, state in self._scan().items():
+            if self.known.get(path) == state:
+                continue
+            if self.changing.get(path) == state:
+                ready.append(path)
+                self.known[path] = state
+                del self.changing[path]
+            else:
+                self.changing[path] = state
+        return ready
+
+    def close(self):
+        pass
+
+def watch_directory(directory, polling=False):
+    if not os.path.isdir(directory):
+        raise NotADirectoryError(f"Not a directory: {directory}")
+    if not polling and sys.platform.startswith('linux'):
         try:
-            import ctypes
-            from ctypes import wintypes
-            k = ctypes.WinDLL('kernel32', use_last_error=True)
-            class FT(ctypes.Structure):
-                _fields_ = [("dwLowDateTime", wintypes.DWORD), ("dwHighDateTime", wintypes.DWORD)]
-            ns = int(ts * 10000000) + 116444736000000000
-            ft = FT(dwLowDateTime=ns & 0xFFFFFFFF, dwHighDateTime=ns >> 32)
-            h = k.CreateFileW(path, 0x100, 0, None, 3, 0, None)
-            if h != -1:
-                k.SetFileTime(h, ctypes.byref(ft), None, None)
-                k.CloseHandle(h)
-        except:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
             pass
+    return PollingWatcher(directory)
+
+WATCH_KEYS = {'name', 'pattern', 'group', 'count', 'window', 'output'}
+
+def load_watch_rules(path):
+    """Read watch rules: a list, or {"defaults": {...}, "rules": [...]} shaped like a manifest."""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {'rules': data}
+    base_dir = os.path.dirname(os.path.abspath(path))
+    defaults = dict(DEFAULT_SETTINGS, **data.get('defaults', {}))
+    rules = []
+    for i, entry in enumerate(data.get('rules', [])):
+        unknown = set(entry) - set(DEFAULT_SETTINGS) - WATCH_KEYS
+        if unknown:
+            raise ValueError(f"Rule {i}: unknown keys {sorted(unknown)}")
+        rules.append(make_watch_rule(entry.get('name') or f"rule{i + 1}",
+                                     dict(defaults, **{k: v for k, v in entry.items() if k in DEFAULT_SETTINGS}),
+                                     entry.get('pattern', "*"), entry.get('group'), entry.get('count', 0),
+                                     entry.get('window', 0),
+                                     entry.get('output') and os.path.join(base_dir, os.path.expanduser(entry['output']))))
+    return rules
+
+def make_watch_rule(name, settings, pattern="*", group=None, count=0, window=0, output=None):
+    if not count and not window:
+        raise ValueError(f"Watch rule {name}: needs a count or a time window")
+    return {'name': name, 'settings': settings, 'pattern': pattern, 'group': group and re.compile(group),
+            'count': count, 'window': window, 'output': output}
+
+def prewarm(path, s):
+    """Pay a new arrival's probe and decode now, while its group is still filling up."""
+    if META_CACHE.get(path).error:
+        return
+    try:
+        if s.get('engine') == "magick" and s.get('animate', "off") == "off":
+            PIXEL_CACHE.stage_mpc([path])
+        else:
+            PIXEL_CACHE.get(path)
+    except Exception:
+        pass  # the merge itself will decode it, and report any real problem
+
+def watch(directory, rules, workers=0, polling=False, existing=False, stop=None, progress=print_progress):
+    """Merge files arriving in `directory` in groups per `rules` until `stop` is set; returns the results."""
+    stop = stop or threading.Event()
+    watcher = watch_directory(directory, polling)
+    GOVERNOR.jobs = workers or os.cpu_count() or 1
+    groups, produced, results, futures = {}, set(), [], []
+    with ThreadPoolExecutor(max_workers=GOVERNOR.jobs) as merges, ThreadPoolExecutor(max_workers=4) as decodes:
+        def arrived(path):
+            if os.path.abspath(path) in produced or not os.path.isfile(path):
+                return
+            name = os.path.basename(path)
+            for rule in rules:
+                if not fnmatch.fnmatch(name, rule['pattern']):
+                    continue
+                tag = None
+                if rule['group']:
+                    match = rule['group'].search(name)
+                    if not match:
+                        continue
+                    tag = match.group(1) if match.groups() else match.group(0)
+                key = (rule['name'], tag)
+                group = groups.setdefault(key, {'rule': rule, 'sources': [], 'since': time.monotonic()})
+                group['sources'].append(path)
+                decodes.submit(prewarm, path, dict(rule['settings'], pixel_cache=True))
+                return
+
+        def launch(key, group):
+            rule, sources = group['rule'], sorted(group['sources'])
+            output = rule['output'] or os.path.dirname(sources[0]) or os.getcwd()
+            if os.path.isdir(output):
+                output = os.path.join(output, output_filename(sources, rule['settings']['mode'],
+                                                              rule['settings']['format']))
+            produced.add(os.path.abspath(output))  # it may land in the watched folder itself
+            try:
+                variants = parse_variants(rule['settings'].get('variants') or "", int(rule['settings']['quality']))
+            except ValueError:
+                variants = []  # run_job reports the bad spec
+            produced.update(os.path.abspath(variant_path(output, v)) for v in variants)
+            job = {'name': f"{key[0]}:{key[1]}" if key[1] else key[0], 'sources': sources, 'output': output,
+                   'settings': dict(rule['settings'], pixel_cache=True)}
+            futures.append(merges.submit(run_job, job))
+
+        if existing:
+            for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+                arrived(entry.path)
+        try:
+            while not stop.is_set():
+                for path in watcher.poll(0.5):
+                    arrived(path)
+                now = time.monotonic()
+                for key, group in list(groups.items()):
+                    rule = group['rule']
+                    if (rule['count'] and len(group['sources']) >= rule['count']) or \
+                            (rule['window'] and now - group['since'] >= rule['window']):
+                        del groups[key]
+                        launch(key, group)
+                for future in [f for f in futures if f.done()]:
+                    futures.remove(future)
+                    results.append(future.result())
+                    progress(len(results), len(results) + len(futures), results[-1])
+        finally:
+            watcher.close()
+        for future in futures:
+            results.append(future.result())
+            progress(len(results), len(results), results[-1])
+    return results
+
+def cli(argv):
+    parser = argparse.ArgumentParser(prog="ImageMerger", description="Merge images without the GUI.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    batch = sub.add_parser('batch', help="run every job in a JSON manifest")
+    batch.add_argument('manifest')
+    batch.add_argument('-j', '--jobs', type=int, default=0, help="parallel jobs (default: CPU count)")
+    batch.add_argument('--timeout', type=int, default=600, help="per-job timeout in seconds")
+    batch.add_argument('--report', help="write per-job results as JSON to this file")
+    batch.add_argument('--meta-cache', metavar='DB', help="SQLite file caching image dimensions between runs")
+    batch.add_argument('--cache', action='store_true', help="reuse identical earlier results (cache_outputs for every job)")
+    batch.add_argument('--hash-contents', action='store_true', help="key the result cache on file contents, not mtime")
+    batch.add_argument('--memory', type=int, default=0, metavar='MIB',
+                       help="memory all jobs together may use (default: 3/4 of what is available)")
+    batch.add_argument('--magick-tmpdir', metavar='DIR', help="scratch space for ImageMagick's disk pixel cache")
+    batch.add_argument('--pixel-cache', action='store_true',
+                       help="keep decoded sources on disk for later merges (pixel_cache for every job)")
+    batch.add_argument('--variants', metavar='SPEC',
+                       help="also write these encodings of every job's composite, e.g. webp:80,jpg:500k,webp:0.98")
+    batch.add_argument('--trace', metavar='FILE', help="append per-stage timing spans to this file as JSON lines")
+    batch.add_argument('--monitor', action='store_true', help="run magick with -monitor and time its internal stages")
+    batch.add_argument('--bench', type=int, default=0, metavar='N',
+                       help="run each magick command N times with -bench and log its timing (implies --monitor)")
+    batch.add_argument('-v', '--verbose', action='store_true', help="log every timing span")
+    cache = sub.add_parser('cache', help="show or clear the result and decoded pixel caches")
+    cache.add_argument('--clear', action='store_true')
+    for p in (batch, cache):
+        p.add_argument('--cache-dir', default=OUTPUT_CACHE.directory, help="result cache location")
+        p.add_argument('--cache-size', type=int, default=OUTPUT_CACHE.max_bytes // 2**20, help="result cache limit in MiB")
+        p.add_argument('--pixel-cache-dir', default=PIXEL_CACHE.directory, help="decoded pixel cache location")
+        p.add_argument('--pixel-cache-size', type=int, default=PIXEL_CACHE.max_bytes // 2**20,
+                       help="decoded pixel cache limit in MiB")
+    watcher = sub.add_parser('watch', help="merge files as they arrive in a folder")
+    watcher.add_argument('directory')
+    watcher.add_argument('--rules', metavar='FILE', help="JSON watch rules (see load_watch_rules)")
+    watcher.add_argument('--pattern', default="*", help="without --rules: file name glob to collect")
+    watcher.add_argument('--group', metavar='REGEX', help="without --rules: files with the same capture merge together")
+    watcher.add_argument('--count', type=int, default=0, help="without --rules: merge every N files")
+    watcher.add_argument('--window', type=float, default=0, help="without --rules: merge N seconds after a group starts")
+    watcher.add_argument('--output', help="without --rules: output file or folder")
+    watcher.add_argument('--existing', action='store_true', help="treat files already there as new arrivals")
+    watcher.add_argument('--poll', action='store_true', help="poll instead of using inotify")
+    watcher.add_argument('-j', '--jobs', type=int, default=0, help="parallel merges (default: CPU count)")
+    bench = sub.add_parser('bench', help="time every layout mode and the preview on synthetic images")
+    bench.add_argument('--counts', default="10,100,1000", help="comma-separated image counts (up to thousands)")
+    bench.add_argument('--cases', default=",".join(BENCH_CASES), help="comma-separated cases")
+    bench.add_argument('--engines', default="magick,pillow", help="comma-separated engines")
+    bench.add_argument('--size', default="800x600", help="nominal source size WxH")
+    bench.add_argument('--seed', type=int, default=0, help="corpus seed")
+    bench.add_argument('--corpus', metavar='DIR', help="keep the generated corpus here and reuse it")
+    bench.add_argument('--repeat', type=int, default=1, help="runs per case; the fastest is reported")
+    bench.add_argument('--json', metavar='FILE', help="write the report to this file")
+    bench.add_argument('--compare', nargs='+', metavar='REPORT',
+                       help="compare against a baseline report (BASELINE [CURRENT]; without CURRENT, run now)")
+    bench.add_argument('--threshold', type=float, default=0.15, help="regression threshold, 0.15 = 15%%")
+    bench.add_argument('--run-case', help=argparse.SUPPRESS)
+    bench.add_argument('--run-streaming', help=argparse.SUPPRESS)
+    bench.add_argument('--streaming', type=int, metavar='SIDE',
+                       help="check the streaming engine's peak memory on a SIDE x SIDE output, e.g. 50000")
+    bench.add_argument('--memory-budget', type=int, default=512, metavar='MIB', help="memory_budget for --streaming")
+    bench.add_argument('--pack', metavar='COUNTS', help="benchmark only the Ashlar packer, e.g. 100,1000,10000")
+    bench.add_argument('--prenormalize', metavar='WORKERS',
+                       help="benchmark grid pre-normalization with these worker counts (on the largest --counts)")
+    args = parser.parse_args(argv)
+
+    if args.command in ('batch', 'cache'):
+        OUTPUT_CACHE.directory, OUTPUT_CACHE.max_bytes = args.cache_dir, args.cache_size * 2**20
+        PIXEL_CACHE.directory, PIXEL_CACHE.max_bytes = args.pixel_cache_dir, args.pixel_cache_size * 2**20
+    if args.command == 'cache':
+        if args.clear:
+            OUTPUT_CACHE.clear()
+            PIXEL_CACHE.clear()
+        print(json.dumps(dict(OUTPUT_CACHE.stats(), pixels=PIXEL_CACHE.stats()), indent=2))
+        return 0
+    if args.command == 'bench' and args.pack:
+        benchmark_packing([int(c) for c in args.pack.split(',')])
+        return 0
+    if args.command == 'bench' and args.prenormalize:
+        size = tuple(int(v) for v in args.size.lower().split('x'))
+        benchmark_prenormalize(max(int(c) for c in args.counts.split(',')),
+                               [int(w) for w in args.prenormalize.split(',')], size)
+        return 0
+    if args.command == 'bench' and args.streaming:
+        return 0 if benchmark_streaming(args.streaming, budget=args.memory_budget)['error'] is None else 1
+    if args.command == 'bench' and args.run_streaming:
+        spec = json.loads(args.run_streaming)
+        try:
+            result = run_streaming_case(spec['side'], spec['tile'], spec['budget'], spec['out'])
+        except Exception as e:
+            result = {'error': str(e)}
+        result['peak_rss_mb'] = peak_rss_mb()
+        print(json.dumps(result))
+        return 0
+    if args.command == 'bench' and args.run_case:
+        spec = json.loads(args.run_case)
+        sources = make_synthetic_images(spec['corpus'], spec['corpus_count'], tuple(spec['size']), spec['seed'])
+        try:
+            result = run_bench_case(spec['case'], spec['engine'], sources[:spec['count']], spec['out'])
+        except Exception as e:
+            result = {'error': str(e)}
+        result['peak_rss_mb'] = peak_rss_mb()
+        print(json.dumps(result))
+        return 0
+    if args.command == 'bench':
+        if args.compare and len(args.compare) > 1:
+            with open(args.compare[1], encoding='utf-8') as f:
+                current = json.load(f)
+        else:
+            size = tuple(int(v) for v in args.size.lower().split('x'))
+            current = benchmark_suite([int(c) for c in args.counts.split(',')], args.cases.split(','),
+                                      args.engines.split(','), size, args.seed, args.repeat, args.corpus)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(current, f, indent=2)
+        if args.compare:
+            with open(args.compare[0], encoding='utf-8') as f:
+                regressions = compare_benchmarks(json.load(f), current, args.threshold)
+            for r in regressions:
+                print(f"REGRESSION {r['case']} {r['engine']} x{r['count']}: {r['metric']} "
+                      f"{r['before']:.3f} -> {r['after']:.3f} ({r['change']:+.0%})")
+            return 1 if regressions else 0
+        return 0
+
+    if args.command == 'watch':
+        if not os.path.isdir(args.directory):
+            parser.error(f"not a directory: {args.directory}")
+        try:
+            if args.rules:
+                rules = load_watch_rules(args.rules)
+            else:
+                rules = [make_watch_rule("watch", dict(DEFAULT_SETTINGS), args.pattern, args.group, args.count,
+                                         args.window, args.output)]
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        META_CACHE.attach(os.path.join(CACHE_DIR, 'metadata.sqlite'))
+        print(f"Watching {args.directory} (Ctrl+C to stop)", flush=True)
+        try:
+            watch(args.directory, rules, args.jobs, args.poll, args.existing)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.meta_cache:
+        META_CACHE.attach(args.meta_cache)
+
+    if args.trace:
+        TRACER.add_sink(JsonLinesSink(args.trace))
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        TRACER.add_sink(LogSink())
+    TRACER.monitor_magick = args.monitor or args.bench > 0
+    TRACER.magick_bench = args.bench
+    GOVERNOR.memory, GOVERNOR.tmpdir = args.memory * 2**20, args.magick_tmpdir
+
+    jobs = load_manifest(args.manifest)
+    OUTPUT_CACHE.hash_contents = args.hash_contents
+    for job in jobs:
+        if args.cache:
+            job['settings']['cache_outputs'] = True
+        if args.pixel_cache:
+            job['settings']['pixel_cache'] = True
+        if args.variants:
+            job['settings']['variants'] = args.variants
+    start = time.perf_counter()
+    results = run_batch(jobs, args.jobs, args.timeout, progress=print_progress)
+    failed = sum(1 for r in results if not r['ok'])
+    hits = sum(1 for r in results if r['cached'])
+    print(f"{len(results) - failed}/{len(results)} jobs succeeded ({hits} from cache) in {time.perf_counter() - start:.2f}s")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
 
-def main():
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        sys.exit(cli(argv))
+    if tk is None:
+        sys.exit("The GUI needs tkinter (python3-tk on most Linux distributions)")
+    if TkinterDnD is None:
+        sys.exit("The GUI needs tkinterdnd2: pip install tkinterdnd2")
     root = TkinterDnD.Tk()
     ImageMagickMerger(root)
     root.mainloop()